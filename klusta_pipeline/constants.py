@@ -1,4 +1,24 @@
 import os as _os
 
 MAX_CHANS = 256
-TEMPLATE_DIR = _os.path.join(_os.path.dirname(_os.path.realpath(__file__)),'templates')
\ No newline at end of file
+TEMPLATE_DIR = _os.path.join(_os.path.dirname(_os.path.realpath(__file__)),'templates')
+
+# number of samples handled at once by the streaming (bounded-memory) code paths
+WINDOW_SAMPLES = 2**20
+# samples per hdf5 chunk of a chunked recordings/N/data dataset
+CHUNK_ROWS = 2**14
+# bytes of temporaries a chunked in-place operation may allocate at once
+CHUNK_BYTES = 2**26
+# stride of the coarse scan for gaps between recordings in a channel's times, in the blocks hdf5
+# reads at once (chunks, or sieve buffers of contiguous data)
+SCAN_STRIDE = 16
+# extra samples on each side of a window used when fitting local splines
+SPLINE_PAD = 64
+# most memory the chunk buffers of an export (kwd2dat, kwd2mda) may take
+EXPORT_BYTES = 2**27
+# fixed cost of one hdf5 read, in bytes of copying it is worth, when planning sparse slices
+READ_COST_BYTES = 2**17
+# spikes (or events) whose sample numbers are mapped between block and recordings at once
+SPIKE_CHUNK = 2**20
+# elements per hdf5 chunk of the spike tables of a kwik
+SPIKE_CHUNK_ROWS = 2**16
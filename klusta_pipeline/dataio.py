@@ -1,13 +1,16 @@
 
 import os
 import glob
+import zlib
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
 from string import Template
 from shutil import copyfile
 import h5py as h5
 import numpy as np
-from klusta_pipeline import MAX_CHANS, TEMPLATE_DIR
-from klusta_pipeline.utils import chunkit, get_info
+from klusta_pipeline import MAX_CHANS, TEMPLATE_DIR, WINDOW_SAMPLES, SCAN_STRIDE, CHUNK_ROWS
+from klusta_pipeline.utils import chunk_bounds, get_info
 from klusta_pipeline.probe import get_channel_groups, clean_dead_channels, build_geometries
 
 try: import simplejson as json
@@ -40,25 +43,138 @@ def load_catlog(catlog):
         exports = read_catlog(f)
     return exports
 
-def read_recordings(f,chans, inc_times=True):
+class SegmentView(object):
+    '''lazy 1-d view onto a segment of a (1,N) spike2 channel dataset.
+    slicing reads only the requested samples from disk
+    '''
+    def __init__(self, dset, offset=0, length=None):
+        self.dset = dset
+        self.offset = offset
+        self.length = dset.shape[1] - offset if length is None else length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            assert step == 1, 'SegmentView only supports contiguous slices'
+            if stop <= start:
+                return np.empty(0, self.dset.dtype)
+            return self.dset[0, self.offset+start:self.offset+stop]
+        if key < 0:
+            key += self.length
+        return self.dset[0, self.offset+key]
+
+def read_block(times):
+    '''samples of a (1,N) times dataset hdf5 reads to get any one of them:
+    a chunk, or a sieve buffer of contiguous data
+    '''
+    if times.chunks:
+        return times.chunks[1]
+    return max(times.file.id.get_access_plist().get_sieve_buf_size() // times.dtype.itemsize, 1)
+
+def coarse_times(times,stride):
+    '''every `stride`th sample of a (1,N) times dataset, plus the last one.
+    returns the sample indices and their times
+    '''
+    n = times.shape[1]
+    idx = np.arange(0,n,stride)
+    coarse = times[0,::stride]
+    if idx[-1] != n-1:
+        idx = np.append(idx,n-1)
+        coarse = np.append(coarse,times[0,n-1])
+    return idx, coarse
+
+def find_breaks(times,interval,lo,hi,t_lo,t_hi,block):
+    '''samples in [lo,hi) followed by a gap, given the times t_lo and t_hi of samples lo and hi.
+    gaps only add time, so a span without one lasts (hi-lo) intervals: spans that last
+    more are halved with single reads until they fit in one read block, which is read in full
+    '''
+    if t_hi-t_lo <= (hi-lo+0.5)*interval:
+        return []
+    if hi-lo <= block:
+        dt = np.diff(times[0,lo:hi+1])
+        return list(lo + np.nonzero(dt>1.5*interval)[0])
+    mid = (lo+hi)//2
+    t_mid = times[0,mid]
+    return (find_breaks(times,interval,lo,mid,t_lo,t_mid,block) +
+            find_breaks(times,interval,mid,hi,t_mid,t_hi,block))
+
+def scan_bounds(times,interval,stride=None):
+    '''finds the recording bounds of a regularly sampled channel without reading all its times.
+    the stride defaults to SCAN_STRIDE read blocks, so the coarse scan skips most of the
+    storage. returns the same (start,stop) bounds as chunk_bounds
+    '''
+    n = times.shape[1]
+    block = read_block(times)
+    idx, coarse = coarse_times(times,stride or SCAN_STRIDE*block)
+    breaks = []
+    for k in xrange(len(idx)-1):
+        breaks += find_breaks(times,interval,idx[k],idx[k+1],coarse[k],coarse[k+1],block)
+    return zip([0]+[b+1 for b in breaks], breaks+[n])
+
+def recording_bounds(f,chans,stride=None,window=WINDOW_SAMPLES):
+    '''finds the recording breaks once per file.
+    the breaks are located on the first channel with scan_bounds. every other channel
+    is checked against it with single reads: same length, same offset at its first and
+    last samples, and a gap at every break. gaps only add time, so a gap of its own
+    would move its last sample. it only gets a full scan if the check fails.
+    returns {channel label: [(start,stop),...]}
+    '''
+    ref = f[chans[0]]['times']
+    interval = np.ravel(f[chans[0]]['interval'])[0]
+    ref_bounds = scan_bounds(ref,interval,stride=stride)
+    ref_first, ref_last = ref[0,0], ref[0,-1]
+
+    bounds = {chans[0]: ref_bounds}
+    for ch in chans[1:]:
+        times = f[ch]['times']
+        interval = np.ravel(f[ch]['interval'])[0]
+        same = times.shape == ref.shape
+        if same:
+            offset = times[0,0]-ref_first
+            same = abs(times[0,-1]-ref_last-offset) < 0.5*interval
+        for (_,stop),(start,_) in zip(ref_bounds[:-1],ref_bounds[1:]):
+            same = same and (times[0,start]-times[0,stop] > 1.5*interval)
+        if same:
+            bounds[ch] = ref_bounds
+        else:
+            print '  %s does not line up with %s, scanning it in full' % (ch,chans[0])
+            bounds[ch] = chunk_bounds(SegmentView(times),window=window)
+    return bounds
+
+def index_recordings(f,chans, inc_times=True, window=WINDOW_SAMPLES):
+    '''finds the recordings in an open spike2 export without loading them.
+    'values' (and 'times') are SegmentViews into the file, so nothing is read until sliced.
+    times are only read if inc_times is set.
+    '''
     s2mat_recordings = []
+    bounds = recording_bounds(f,chans,window=window)
     for ch in chans:
         chan_data = f[ch]
-        times = chan_data['times'][0]
-        values = chan_data['values'][0]
         fs = 1.0 / chan_data['interval'][0]
-        for ii, (t,v) in enumerate(chunkit(times,values)):
-            d = {ch: {'values':v,'fs':fs, 'start':t[0], 'stop':t[-1], 'length':len(t)}}
+        for ii, (lo,hi) in enumerate(bounds[ch]):
+            d = {ch: {'values':SegmentView(chan_data['values'],lo,hi-lo),'fs':fs, 'start':chan_data['times'][0,lo], 'stop':chan_data['times'][0,hi-1], 'length':hi-lo}}
             if inc_times:
-                d[ch]['times'] = t
+                d[ch]['times'] = SegmentView(chan_data['times'],lo,hi-lo)
             try:
                 s2mat_recordings[ii].update(d)
             except IndexError:
-                print ' rec %i (%0.2f seconds long)' % (ii,t[-1]-t[0])
+                print ' rec %i (%0.2f seconds long)' % (ii,d[ch]['stop']-d[ch]['start'])
                 s2mat_recordings.append(d)
         print '  %s' % ch
     return s2mat_recordings
 
+def read_recordings(f,chans, inc_times=True):
+    s2mat_recordings = index_recordings(f,chans, inc_times=inc_times)
+    for r in s2mat_recordings:
+        for ch in chans:
+            r[ch]['values'] = r[ch]['values'][:]
+            if inc_times:
+                r[ch]['times'] = r[ch]['times'][:]
+    return s2mat_recordings
+
 def load_recordings(s2mat,chans, inc_times=True):
     recordings = []
     print 'Loading %s' % s2mat
@@ -69,6 +185,17 @@ def load_recordings(s2mat,chans, inc_times=True):
         recordings += recs
     return recordings
 
+def load_recording_index(s2mat,chans):
+    '''the recordings of a spike2 export, as index_recordings finds them (bounds, start and stop
+    of each channel), without reading any values. the views into the file are closed with it
+    '''
+    print 'Indexing %s' % s2mat
+    with h5.File(s2mat, 'r') as f:
+        recs = index_recordings(f,chans, inc_times=False)
+    for r in recs:
+        r.update(file_origin=s2mat)
+    return recs
+
 def load_digmark(s2mat):
     with h5.File(s2mat, 'r') as f:
         times = np.array(f['DigMark']['times']).T.squeeze()
@@ -95,11 +222,122 @@ def load_stim_info(s2mat):
     assert len(codes)==len(names)
     return codes, times, names
 
-def save_recording(kwd,rec,index):
-    with h5.File(kwd, 'a') as kwd_f:
+def write_recording(kwd_f,rec,index,chunk_rows=None,compression=None,shuffle=False,level=4,threads=None):
+    '''writes rec['data'] as recordings/N/data of an open kwd file.
+    contiguous and uncompressed unless chunk_rows or compression are given,
+    in which case it goes through a RecordingWriter
+    '''
+    if chunk_rows is None and compression is None:
         print ' saving recordings/%i/data...' % index
         kwd_f.create_dataset('recordings/%i/data' % index, data=rec['data'])
-        print ' saved!'
+    else:
+        writer = RecordingWriter(kwd_f,index,rec['data'].shape[1],dtype=rec['data'].dtype,
+                                 chunk_rows=chunk_rows or CHUNK_ROWS,compression=compression,
+                                 shuffle=shuffle,level=level,threads=threads)
+        writer.write(rec['data'])
+        writer.close()
+    print ' saved!'
+
+def save_recording(kwd,rec,index,**layout):
+    with h5.File(kwd, 'a') as kwd_f:
+        write_recording(kwd_f,rec,index,**layout)
+
+class RecordingWriter(object):
+    '''appends blocks of samples to a resizable, chunked recordings/N/data dataset.
+    chunks span all channels and chunk_rows samples, so time slabs read whole chunks.
+    with gzip compression, whole chunks are shuffled and deflated on a pool of `threads`
+    threads and stored with direct chunk writes; otherwise h5py writes them as usual.
+    keeps running column sums so the recording mean is known without re-reading it.
+    call flush() once all blocks are written and close() when done with write_at().
+    '''
+    def __init__(self, kwd_f, index, n_chans, dtype=np.int16, chunk_rows=CHUNK_ROWS,
+                 compression=None, shuffle=False, level=4, threads=None):
+        print ' streaming recordings/%i/data...' % index
+        self.dset = kwd_f.create_dataset('recordings/%i/data' % index,
+                                         shape=(0,n_chans),
+                                         maxshape=(None,n_chans),
+                                         chunks=(chunk_rows,n_chans),
+                                         dtype=dtype,
+                                         compression=compression,
+                                         compression_opts=level if compression=='gzip' else None,
+                                         shuffle=shuffle)
+        self.chunk_rows = chunk_rows
+        self.shuffle = shuffle
+        self.level = level
+        self.direct = compression=='gzip'
+        self.pool = ThreadPool(threads or cpu_count()) if self.direct else None
+        self.pending = np.empty((0,n_chans), dtype)
+        self.n = 0
+        self.sum = np.zeros(n_chans, np.int64)
+
+    def write(self, block):
+        self.sum += block.sum(axis=0, dtype=np.int64)
+        self.n += len(block)
+        if not self.direct:
+            n = self.dset.shape[0]
+            self.dset.resize(n+len(block), axis=0)
+            self.dset[n:] = block
+            return
+        if len(self.pending):
+            block = np.vstack((self.pending,block))
+        if self.n <= self.chunk_rows:
+            # held back until the recording spans two chunks, see _plain
+            self.pending = block.copy()
+            return
+        full = len(block) // self.chunk_rows * self.chunk_rows
+        self._write_chunks(self.n-len(block), block[:full])
+        self.pending = block[full:].copy()
+
+    def _plain(self):
+        # hdf5 1.10 reads a recording that fits in one chunk as zeros through this handle
+        # once the chunk was written directly, so those go through the filter pipeline
+        return not self.direct or self.n <= self.chunk_rows
+
+    def flush(self):
+        if len(self.pending):
+            start = self.n-len(self.pending)
+            if self._plain():
+                self.dset.resize(self.n, axis=0)
+                self.dset[start:] = self.pending
+            else:
+                self._write_chunks(start, self.pending)
+            self.pending = self.pending[:0]
+
+    def write_at(self, start, block):
+        '''overwrites rows start:start+len(block) of the flushed dataset'''
+        stop = start+len(block)
+        aligned = start % self.chunk_rows == 0 and (stop % self.chunk_rows == 0 or stop == self.n)
+        if aligned and not self._plain():
+            self._write_chunks(start, block)
+        else:
+            self.dset[start:stop] = block
+
+    def close(self):
+        self.flush()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def _compress(self, chunk):
+        if len(chunk) < self.chunk_rows:
+            # hdf5 always stores whole chunks
+            chunk = np.vstack((chunk, np.zeros((self.chunk_rows-len(chunk),chunk.shape[1]),chunk.dtype)))
+        raw = np.ascontiguousarray(chunk).view(np.uint8)
+        if self.shuffle:
+            raw = raw.reshape(-1,chunk.dtype.itemsize).T
+        return zlib.compress(raw.tobytes(), self.level)
+
+    def _write_chunks(self, start, data):
+        stop = start+len(data)
+        if stop > self.dset.shape[0]:
+            self.dset.resize(stop, axis=0)
+        chunks = (data[ii:ii+self.chunk_rows] for ii in xrange(0,len(data),self.chunk_rows))
+        for ii, compressed in enumerate(self.pool.imap(self._compress, chunks)):
+            self.dset.id.write_direct_chunk((start+ii*self.chunk_rows,0), compressed)
+
+    def mean(self):
+        # the int64 sum is exact, so this matches data.mean(axis=0) bit for bit
+        return self.sum / float(self.n)
 
 def save_chanlist(kwd_dir,chans,port_map):
     chanfile = os.path.join(kwd_dir,'indx_port_site.txt')
@@ -1,25 +1,88 @@
 # Functions to do stuff with h5 files
 from __future__ import division
+import os
+import errno
+import contextlib
+import ctypes
+import ctypes.util
 import numpy as np
 import logging
+import threading
+import Queue
 import h5py
 import json
-from mdaio import readmda
+from mdaio import readmda, MdaHeader, _write_header
+from constants import EXPORT_BYTES, READ_COST_BYTES, SPIKE_CHUNK, SPIKE_CHUNK_ROWS
+
+
+class H5Pool(object):
+    """
+    Open h5 files, shared by path. A file is opened by the first user that asks for it and closed
+    when the last one lets it go, so nested uses of the same file share one handle:
+        with h5_pool.open(kwd) as kwd_f:
+            get_rec_sizes(kwd)  # no new open
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self._users = {}
+
+    def acquire(self, path, mode='r'):
+        """
+        :param path: path to the h5 file
+        :param mode: 'r' or 'r+'
+        :return: the open h5py.File. has to be given back with release()
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            if path not in self._files:
+                self._files[path] = h5py.File(path, mode)
+                self._users[path] = 0
+            h5_file = self._files[path]
+            if mode != 'r' and h5_file.mode == 'r':
+                raise IOError('{} is already open read-only'.format(path))
+            self._users[path] += 1
+            return h5_file
+
+    def release(self, path):
+        path = os.path.realpath(path)
+        with self._lock:
+            self._users[path] -= 1
+            if self._users[path] == 0:
+                self._files.pop(path).close()
+                self._users.pop(path)
+
+    @contextlib.contextmanager
+    def open(self, h5_file, mode='r'):
+        """
+        Context manager giving an open h5py.File for a path (from the pool) or an open file (as is).
+        """
+        if isinstance(h5_file, h5py.File):
+            yield h5_file
+            return
+        h5_file = self.acquire(h5_file, mode)
+        try:
+            yield h5_file
+        finally:
+            self.release(h5_file.filename)
+
+
+h5_pool = H5Pool()
 
 
 def h5_wrap(h5_function):
     """
     Decorator to open h5 files if the path was provided to a function.
+    Files are taken from h5_pool, and closed once no one else is using them.
     :param h5_function: a function that receives an h5file as first argument
     :return: decorated function that takes open('r' mode) or path as first argument
     """
 
     def file_checker(h5_file, *args, **kwargs):
-        if type(h5_file) is not h5py._hl.files.File:
-            h5_file = h5py.File(h5_file, 'r')
-        logging.debug('H5 file: {}'.format(h5_file))
-        return_value = h5_function(h5_file, *args, **kwargs)
-        return return_value
+        with h5_pool.open(h5_file) as h5_file:
+            logging.debug('H5 file: {}'.format(h5_file))
+            return h5_function(h5_file, *args, **kwargs)
 
     return file_checker
 
@@ -52,119 +115,602 @@ def get_data_set(kwd_file, rec):
     return kwd_file['/recordings/{}/data'.format(int(rec))]
 
 
+def contiguous_offset(data_set):
+    """
+    :param data_set: h5 dataset
+    :return: offset in the file of the dataset's data, if it is stored as one contiguous,
+    uncompressed block of native-endian values; else None
+    """
+    if data_set.chunks is not None or data_set.compression is not None or data_set.size == 0:
+        return None
+    if not data_set.dtype.isnative:
+        return None
+    return data_set.id.get_offset()
+
+
 # Table functions
-def load_table_slice(table, row_list=None, col_list=None):
+def _index_runs(index):
+    """
+    Splits a list of indices into runs of consecutive increasing values.
+    :param index: np.array of indices, in the order they are requested
+    :return: list of (first index, position of the run in the list, run length)
+    """
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(index)]))
+    return [(int(index[a]), int(a), int(b - a)) for a, b in zip(starts, stops)]
+
+
+def _axis_reads(index, by_run):
+    """
+    Reads along one axis of a slice, as (first index, length, destination, take), where
+    take is None if the read goes straight to the destination, else the positions to take from it.
+    """
+    if by_run:
+        return [(first, length, slice(dst, dst + length), None) for first, dst, length in _index_runs(index)]
+    first = int(np.min(index))
+    return [(first, int(np.max(index)) - first + 1, slice(None), index - first)]
+
+
+def _touched(first, length, block):
+    # indices hdf5 goes through to read [first, first + length) when it reads whole blocks of `block`
+    return (-(-(first + length) // block) - first // block) * block
+
+
+def plan_table_slice(row_list, col_list, itemsize, blocks, compressed=False, read_cost=READ_COST_BYTES):
+    """
+    Chooses, for rows and columns, between reading the bounding box of the requested indices
+    and reading each run of consecutive indices. Every read goes through the whole storage blocks
+    it overlaps (sieving a contiguous table's rows, decompressing chunks), so a read is priced at
+    the blocks it touches, plus the copies out of a staging buffer and a fixed cost per read.
+    Column runs only pay off when the blocks partition the columns.
+    :param row_list: np.array of rows to get
+    :param col_list: np.array of cols to get
+    :param itemsize: bytes per element of the table
+    :param blocks: (rows, cols) read as a whole: the chunk shape, or (1, all cols) for contiguous storage
+    :param compressed: whether the blocks have to be decompressed, which costs more than copying
+    :param read_cost: cost of one read, in bytes
+    :return: (rows_by_run, cols_by_run) booleans
+    """
+    weight = 4 if compressed else 1
+    row_reads = {True: [(first, length) for first, _, length in _index_runs(row_list)],
+                 False: [(int(np.min(row_list)), int(np.ptp(row_list)) + 1)]}
+    col_reads = {True: [(first, length) for first, _, length in _index_runs(col_list)],
+                 False: [(int(np.min(col_list)), int(np.ptp(col_list)) + 1)]}
+    best = None
+    for rows_by_run in (True, False):
+        for cols_by_run in (True, False):
+            rows = row_reads[rows_by_run]
+            cols = col_reads[cols_by_run]
+            touched = sum(_touched(first, length, blocks[0]) for first, length in rows) * \
+                sum(_touched(first, length, blocks[1]) for first, length in cols)
+            cost = touched * itemsize * weight + len(rows) * len(cols) * read_cost
+            if not (rows_by_run and cols_by_run):
+                # staged reads are copied into place afterwards
+                cost += sum(length for _, length in rows) * sum(length for _, length in cols) * itemsize
+            if best is None or cost < best[0]:
+                best = (cost, rows_by_run, cols_by_run)
+    return best[1:]
+
+
+def load_table_slice(table, row_list=None, col_list=None, out=None):
     """
     Loads a slice of a h5 dataset.
-    It can load sparse columns and rows. To do this, it first grabs the smallest chunks that contains them.
+    It can load sparse columns and rows, in any order. Requested indices are coalesced into runs of
+    consecutive values; each run is read straight into the output, unless reading the bounding box
+    and picking from it is cheaper (see plan_table_slice).
     :param table: dataset of an h5 file.
     :param row_list: list of rows to get (int list)
     :param col_list: list of cols to get (int list)
+    :param out: C-contiguous np.array of shape (len(row_list), len(col_list)) to load into (optional)
     :return: np.array of size row_list, col_list with the concatenated rows, cols.
     """
     table_cols = table.shape[1]
     table_rows = table.shape[0]
     d_type = table.dtype
 
-    col_list = np.arange(table_cols) if col_list is None else np.array(col_list)
-    row_list = np.arange(table_rows) if row_list is None else np.array(row_list)
+    col_list = np.arange(table_cols) if col_list is None else np.array(col_list, dtype=np.int64)
+    row_list = np.arange(table_rows) if row_list is None else np.array(row_list, dtype=np.int64)
+    if out is None:
+        out = np.empty([row_list.size, col_list.size], dtype=np.dtype(d_type))
+    if out.size == 0:
+        return out
+
+    blocks = table.chunks or (1, table_cols)
+    rows_by_run, cols_by_run = plan_table_slice(row_list, col_list, np.dtype(d_type).itemsize, blocks,
+                                                compressed=table.compression is not None)
+    for row_first, n_rows, row_dst, row_take in _axis_reads(row_list, rows_by_run):
+        for col_first, n_cols, col_dst, col_take in _axis_reads(col_list, cols_by_run):
+            source = np.s_[row_first: row_first + n_rows, col_first: col_first + n_cols]
+            if row_take is None and col_take is None:
+                table.read_direct(out, source, np.s_[row_dst, col_dst])
+                continue
+            block = np.empty([n_rows, n_cols], dtype=np.dtype(d_type))
+            table.read_direct(block, source)
+            if row_take is not None:
+                block = block[row_take]
+            if col_take is not None:
+                block = block[:, col_take]
+            out[row_dst, col_dst] = block
+    return out
+
+
+# one view over all the recordings of a kwd
+class KwdReader(object):
+    """
+    A kwd opened once, with its recordings indexed, readable as one (total_samples, n_chans) array
+    indexed by global sample. Slices that cross recording boundaries are stitched from each recording.
+    Recordings stored contiguous and uncompressed are read through np.memmap instead of hdf5.
+    """
+    def __init__(self, kwd_file, use_memmap=True):
+        """
+        :param kwd_file: kwd file or path to it. A file taken from h5_pool by the reader is given back by close()
+        :param use_memmap: map contiguous recordings with np.memmap
+        """
+        self._owns_file = not isinstance(kwd_file, h5py.File)
+        self.kwd_file = h5_pool.acquire(kwd_file) if self._owns_file else kwd_file
+        self.rec_list = get_rec_list(self.kwd_file)
+        self.data_sets = [get_data_set(self.kwd_file, rec) for rec in self.rec_list]
+        assert len(self.data_sets) > 0, 'no recordings in {}'.format(self.kwd_file.filename)
+        self.n_chans = self.data_sets[0].shape[1]
+        self.dtype = self.data_sets[0].dtype
+        assert all(data_set.shape[1] == self.n_chans for data_set in self.data_sets), \
+            'recordings differ in number of channels'
+        assert all(data_set.dtype == self.dtype for data_set in self.data_sets), 'recordings differ in data type'
+        self.rec_sizes = np.array([data_set.shape[0] for data_set in self.data_sets], dtype=np.int64)
+        self.rec_starts = np.hstack([0, self.rec_sizes.cumsum()[:-1]]).astype(np.int64)
+        self.n_samples = int(self.rec_sizes.sum())
+        self.sample_rates = [data_set.parent.attrs.get('sample_rate') for data_set in self.data_sets]
+        self._maps = [self._memmap(data_set) if use_memmap else None for data_set in self.data_sets]
+
+    def _memmap(self, data_set):
+        offset = contiguous_offset(data_set)
+        if offset is None:
+            return None
+        return np.memmap(self.kwd_file.filename, dtype=self.dtype, mode='r', offset=offset, shape=data_set.shape)
+
+    @property
+    def shape(self):
+        return self.n_samples, self.n_chans
+
+    def __len__(self):
+        return self.n_samples
+
+    def rec_index(self, rec):
+        """
+        :param rec: number of rec
+        :return: position of the rec in rec_list
+        """
+        return int(np.flatnonzero(self.rec_list == int(rec))[0])
+
+    def is_mapped(self, rec):
+        return self._maps[self.rec_index(rec)] is not None
+
+    def read(self, start, stop, chan_list=None, out=None):
+        """
+        Reads global samples [start, stop) of the channels in chan_list.
+        :param start: first sample
+        :param stop: sample after the last
+        :param chan_list: list of channels, in the order to get them. Default (None) is all of them
+        :param out: C-contiguous np.array of shape (stop - start, channels) to read into (optional)
+        :return: np.array (samples x channels)
+        """
+        assert 0 <= start <= stop <= self.n_samples, 'samples [{}, {}) out of range'.format(start, stop)
+        n_out = self.n_chans if chan_list is None else len(chan_list)
+        if out is None:
+            out = np.empty((stop - start, n_out), dtype=self.dtype)
+        first = max(np.searchsorted(self.rec_starts, start, side='right') - 1, 0)
+        for i in range(first, len(self.data_sets)):
+            rec_start = self.rec_starts[i]
+            if rec_start >= stop:
+                break
+            a = max(start, rec_start) - rec_start
+            b = min(stop, rec_start + self.rec_sizes[i]) - rec_start
+            if b <= a:
+                continue
+            dest = out[a + rec_start - start: b + rec_start - start]
+            if self._maps[i] is not None:
+                dest[:] = self._maps[i][a:b] if chan_list is None else self._maps[i][a:b, chan_list]
+            else:
+                load_table_slice(self.data_sets[i], np.arange(a, b), chan_list, out=dest)
+        return out
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        chan_list = np.arange(self.n_chans)[cols]
+        squeeze_cols = np.ndim(chan_list) == 0
+        chan_list = None if isinstance(cols, slice) and cols == slice(None) else np.atleast_1d(chan_list)
+        if isinstance(rows, slice):
+            row_list = np.arange(self.n_samples)[rows]
+        else:
+            row_list = np.arange(self.n_samples)[np.atleast_1d(rows)]
+        if row_list.size == 0:
+            data = np.empty((0, self.n_chans if chan_list is None else len(chan_list)), dtype=self.dtype)
+        else:
+            first = int(row_list.min())
+            data = self.read(first, int(row_list.max()) + 1, chan_list)
+            if not (isinstance(rows, slice) and rows.step in (None, 1)):
+                data = data[row_list - first]
+        if squeeze_cols:
+            data = data[:, 0]
+        if np.ndim(rows) == 0 and not isinstance(rows, slice):
+            data = data[0]
+        return data
+
+    def close(self):
+        self._maps = [None for _ in self._maps]
+        if self._owns_file:
+            h5_pool.release(self.kwd_file.filename)
+            self._owns_file = False
+
+    def __enter__(self):
+        return self
 
-    raw_table_slice = np.empty([np.ptp(row_list) + 1, np.ptp(col_list) + 1], dtype=np.dtype(d_type))
-    table.read_direct(raw_table_slice,
-                      np.s_[np.min(row_list): np.max(row_list) + 1, np.min(col_list): np.max(col_list) + 1])
-    # return raw_table_slice
-    return raw_table_slice[row_list - np.min(row_list), :][:, col_list - np.min(col_list)]
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 # passing stuff to binary
-def dset_to_binary_file(data_set, out_file, chan_list=None, chunk_size=8000000):
+def _read_chunks(data_set, chan_list, bounds, free, full):
     """
-    :param data_set: a table from an h5 file to write to a binary. has to be daughter of a rec
-    :param out_file: binary file - has to be open in 'w' mode.
-    :param chan_list: list of channels (must be list or tuple). Default (None) will do the whole table
-    :param chunk_size: size in samples of the chunk
-    :return:
+    Reader thread of dset_to_binary_file: fills free buffers with consecutive chunks and queues them.
+    Queues None when done, or the exception if reading failed.
+    """
+    try:
+        all_chans = list(chan_list) == range(data_set.shape[1])
+        for start, end in bounds:
+            chunk_buffer = free.get()
+            if all_chans:
+                data_set.read_direct(chunk_buffer, np.s_[start: end], np.s_[0: end - start])
+            else:
+                load_table_slice(data_set, np.arange(start, end), chan_list, out=chunk_buffer[0: end - start])
+            full.put((chunk_buffer, end - start))
+        full.put(None)
+    except Exception as e:
+        full.put(e)
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _libc_call(name, *args):
+    function = getattr(_libc, name, None)
+    if function is None:
+        raise OSError(errno.ENOSYS, '{} is not available'.format(name))
+    function.restype = ctypes.c_ssize_t
+    n = function(*args)
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+def _copy_file_range(src_fd, dst_fd, src_offset, dst_offset, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+    off_in = ctypes.c_int64(src_offset)
+    off_out = ctypes.c_int64(dst_offset)
+    return _libc_call('copy_file_range', ctypes.c_int(src_fd), ctypes.byref(off_in),
+                      ctypes.c_int(dst_fd), ctypes.byref(off_out), ctypes.c_size_t(count), ctypes.c_uint(0))
+
+
+def _sendfile(src_fd, dst_fd, src_offset, dst_offset, count):
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dst_fd, src_fd, src_offset, count)
+    offset = ctypes.c_int64(src_offset)
+    return _libc_call('sendfile', ctypes.c_int(dst_fd), ctypes.c_int(src_fd), ctypes.byref(offset),
+                      ctypes.c_size_t(count))
+
+
+def _buffered_copy(src_fd, dst_fd, src_offset, dst_offset, count):
+    os.lseek(src_fd, src_offset, os.SEEK_SET)
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    data = os.read(src_fd, min(count, EXPORT_BYTES))
+    os.write(dst_fd, data)
+    return len(data)
+
+
+def copy_file_range(src_fd, dst_fd, src_offset, dst_offset, count):
+    """
+    Copies count bytes between two files without passing them through this process:
+    copy_file_range (which shares the blocks on filesystems with reflinks), else sendfile.
+    Falls back to reading and writing if the kernel can do neither for these files.
+    :param src_fd: file descriptor to copy from
+    :param dst_fd: file descriptor to copy to
+    :param src_offset: offset of the bytes in the source
+    :param dst_offset: offset to write them to in the destination
+    :param count: number of bytes
+    :return: name of the method that did the copy
+    """
+    done = 0
+    for method in (_copy_file_range, _sendfile, _buffered_copy):
+        try:
+            while done < count:
+                n = method(src_fd, dst_fd, src_offset + done, dst_offset + done, count - done)
+                if n == 0:
+                    raise EOFError('source ended {} bytes short'.format(count - done))
+                done += n
+            return method.__name__.lstrip('_')
+        except OSError as e:
+            if method is _buffered_copy:
+                raise
+            logging.debug('{} failed after {} bytes: {}'.format(method.__name__, done, e))
+
+
+def available_memory():
+    """
+    :return: bytes of memory available to this process, from /proc/meminfo or sysconf
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def auto_chunk_size(data_set, n_chans, n_buffers=2, max_bytes=EXPORT_BYTES):
+    """
+    Samples per chunk so that n_buffers chunks of n_chans channels fit in max_bytes
+    (or an eighth of the available memory, if less), rounded down to whole hdf5 chunks.
+    :param data_set: dataset the chunks will be read from
+    :param n_chans: number of channels read
+    :param n_buffers: number of chunk buffers in flight
+    :param max_bytes: most memory the buffers may take
+    :return: chunk size in samples
+    """
+    budget = min(max_bytes, available_memory() // 8) // n_buffers
+    samples = max(budget // (n_chans * data_set.dtype.itemsize), 1)
+    if data_set.chunks is not None and samples > data_set.chunks[0]:
+        samples -= samples % data_set.chunks[0]
+    return int(samples)
+
+
+def dset_to_binary_files(data_set, sinks, chunk_size=None, n_buffers=2):
+    """
+    Writes channels of a dataset to several binary files in one pass: each chunk is read once,
+    with the union of the channels of all sinks, and every sink writes its channels from it.
+    Reading and writing overlap: a reader thread fills a bounded pool of reusable buffers
+    while this thread writes the filled ones out.
+    :param data_set: a table from an h5 file to write to binaries. has to be daughter of a rec
+    :param sinks: list of (out_file, chan_list); out_file open in 'w' mode, chan_list a list of channels
+    in the order to write them, or None for the whole table
+    :param chunk_size: size in samples of the chunk. Default (None) sizes it with auto_chunk_size
+    :param n_buffers: number of chunk buffers in flight
+    :return: list with the number of elements written to each sink
     """
     samples_data = data_set.shape[0]
     channels_data = data_set.shape[1]
     data_type = data_set.dtype
     logging.info('Ripping dataset from {}'.format(data_set.parent.name))
-    if chan_list is None:
-        logging.debug('Counting channels')
-        chan_list = range(channels_data)
-    logging.info('Channel list: {}'.format(chan_list))
-
-    samples_chunk = min(chunk_size, samples_data)
-    channels_chunk = len(chan_list)
-
-    chunk_buffer = np.empty((samples_chunk, channels_chunk), dtype=np.dtype(data_type))
+    chan_lists = [range(channels_data) if chan_list is None else list(chan_list) for _, chan_list in sinks]
+    if len(sinks) == 1:
+        read_list = chan_lists[0]
+    else:
+        read_list = sorted(set(chan for chan_list in chan_lists for chan in chan_list))
+    logging.info('Channel list: {}'.format(read_list))
+    # sinks that take the whole buffer write it as is, the others pick their columns
+    picks = [None if chan_list == read_list else np.searchsorted(read_list, chan_list)
+             for chan_list in chan_lists]
+
+    if chunk_size is None:
+        chunk_size = auto_chunk_size(data_set, len(read_list), n_buffers=n_buffers)
+    samples_chunk = max(min(chunk_size, samples_data), 1)
+    channels_chunk = len(read_list)
+
+    free = Queue.Queue()
+    full = Queue.Queue()
+    for i in range(n_buffers):
+        free.put(np.empty((samples_chunk, channels_chunk), dtype=np.dtype(data_type)))
     chunk_starts = np.arange(0, samples_data, samples_chunk)
-    n_chunks = chunk_starts.size
-
-    logging.info('About to store {} entire chunks'.format(n_chunks - 1))
-    for start in chunk_starts:
-        logging.info('Chunk start: {0}'.format(start))
-        end = min(start + samples_chunk, samples_data)
-        chunk_buffer[0: end - start, :] = load_table_slice(data_set,
-                                                           np.arange(start, end),
-                                                           chan_list)
-        out_file.write(chunk_buffer[0: end - start].astype(np.dtype(data_type)).tostring())
-
-    stored = n_chunks * chunk_buffer.size + chunk_buffer[0: end - start, :].size
+    bounds = [(start, min(start + samples_chunk, samples_data)) for start in chunk_starts]
+
+    logging.info('About to store {} chunks in {} files'.format(len(bounds), len(sinks)))
+    reader = threading.Thread(target=_read_chunks, args=(data_set, read_list, bounds, free, full))
+    reader.daemon = True
+    reader.start()
+
+    stored = [0] * len(sinks)
+    while True:
+        item = full.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        chunk_buffer, n_samples = item
+        for i, ((out_file, _), pick) in enumerate(zip(sinks, picks)):
+            if pick is None:
+                out_file.write(memoryview(chunk_buffer[0: n_samples]))
+            else:
+                out_file.write(memoryview(chunk_buffer[0: n_samples].take(pick, axis=1)))
+            stored[i] += n_samples * len(chan_lists[i])
+        free.put(chunk_buffer)
+    reader.join()
+
     logging.info('{} elements written'.format(stored))
     return stored
 
 
+def dset_to_binary_file(data_set, out_file, chan_list=None, chunk_size=None, n_buffers=2, zero_copy=True):
+    """
+    A contiguous, uncompressed dataset exported whole is copied file to file by the kernel (see copy_file_range).
+    Otherwise it is read and written in chunks with dset_to_binary_files.
+    :param data_set: a table from an h5 file to write to a binary. has to be daughter of a rec
+    :param out_file: binary file - has to be open in 'w' (not append) mode.
+    :param chan_list: list of channels (must be list or tuple). Default (None) will do the whole table
+    :param chunk_size: size in samples of the chunk. Default (None) sizes it with auto_chunk_size
+    :param n_buffers: number of chunk buffers in flight
+    :param zero_copy: copy contiguous datasets file to file when possible
+    :return: number of elements written
+    """
+    offset = contiguous_offset(data_set) if zero_copy else None
+    if offset is not None and (chan_list is None or list(chan_list) == range(data_set.shape[1])):
+        # the stored bytes are already the interleaved samples
+        n_bytes = data_set.size * data_set.dtype.itemsize
+        out_file.flush()
+        dst_offset = out_file.tell()
+        with open(data_set.file.filename, 'rb') as src_file:
+            method = copy_file_range(src_file.fileno(), out_file.fileno(), offset, dst_offset, n_bytes)
+        out_file.seek(dst_offset + n_bytes)
+        logging.info('{} elements copied with {}'.format(data_set.size, method))
+        return data_set.size
+    return dset_to_binary_files(data_set, [(out_file, chan_list)], chunk_size=chunk_size, n_buffers=n_buffers)[0]
+
+
+def _open_export(reader, out_file_path, chan_list, file_format):
+    """
+    Opens an export file for writing its samples, after the MDA header of dims (channels, samples) for 'mda'.
+    """
+    if file_format == 'dat':
+        return open(out_file_path, 'wb')
+    assert file_format == 'mda', 'unknown export format {}'.format(file_format)
+    dims = [reader.n_chans if chan_list is None else len(chan_list), reader.n_samples]
+    header = MdaHeader(reader.dtype.name, dims)
+    logging.info('mda dims {}, 64 bit dims: {}'.format(dims, header.uses64bitdims))
+    assert _write_header(out_file_path, header), 'could not write mda header to {}'.format(out_file_path)
+    out_file = open(out_file_path, 'r+b')
+    out_file.seek(0, os.SEEK_END)
+    return out_file
+
+
 @h5_wrap
-def kwd_to_binary(kwd_file, out_file_path, chan_list=None, chunk_size=8000000):
+def kwd_export(kwd_file, exports, chunk_size=None, zero_copy=True):
+    """
+    Writes the recordings of a kwd, concatenated, to several files in one read of the kwd.
+    'dat' files are the flat interleaved samples (kilosort); 'mda' files have dims (channels, samples)
+    (mountainsort). kwd data is samples-major, which is already the channel-fastest order of MDA,
+    so both get the same chunks after their headers.
+    :param kwd_file: kwd file or kwd file
+    :param exports: list of (out_file_path, chan_list, file_format); chan_list is a list of channels
+    in the order to write them, or None for all of them; file_format is 'dat' or 'mda'
+    :param chunk_size: size in samples of the chunk. Default (None) sizes it automatically
+    :param zero_copy: copy contiguous recordings file to file when there is a single export of all channels
+    :return: list of dims (channels, samples) of each export
+    """
+    logging.info('Exporting kwd_file {}'.format(kwd_file.filename))
+    exports = [(path, None if chan_list is None else list(np.atleast_1d(chan_list)), file_format)
+               for path, chan_list, file_format in exports]
+    reader = KwdReader(kwd_file, use_memmap=False)
+    logging.info('Will go through recs {}'.format(reader.rec_list))
+    out_files = [_open_export(reader, path, chan_list, file_format) for path, chan_list, file_format in exports]
+    try:
+        sinks = [(out_file, chan_list) for out_file, (_, chan_list, _) in zip(out_files, exports)]
+        stored = np.zeros(len(sinks), dtype=np.int64)
+        for data_set in reader.data_sets:
+            if len(sinks) == 1:
+                stored[0] += dset_to_binary_file(data_set, out_files[0], chan_list=sinks[0][1],
+                                                 chunk_size=chunk_size, zero_copy=zero_copy)
+            else:
+                stored += dset_to_binary_files(data_set, sinks, chunk_size=chunk_size)
+    finally:
+        for out_file in out_files:
+            out_file.close()
+    dims = [[reader.n_chans if chan_list is None else len(chan_list), reader.n_samples]
+            for _, chan_list, _ in exports]
+    assert all(n == np.prod(d, dtype=np.int64) for n, d in zip(stored, dims))
+    logging.info('{} elements written'.format(stored))
+    return dims
+
+
+def kwd_to_binary(kwd_file, out_file_path, chan_list=None, chunk_size=None, zero_copy=True):
     """
     :param kwd_file: kwd file or kwd file
     :param out_file_path: path to the bin file that will be created
-    :param chan_list: list of channels (must be list or tuple). Default (None) will do the whole table
-    :param chunk_size: size in samples of the chunk
+    :param chan_list: list of channels (must be list or tuple), in the order to write them.
+    Default (None) will do the whole table
+    :param chunk_size: size in samples of the chunk. Default (None) sizes it automatically
+    :param zero_copy: copy contiguous recordings file to file when exporting all channels
     :return:
     """
-    # get the dataset of each recording and concatenateit to the out_file_path
-    logging.info('Writing kwd_file {} to binary'.format(kwd_file.filename))
-    logging.info('Channels to extract: {}'.format(chan_list))
-    logging.info('Creating binary file {}'.format(out_file_path))
-    if chan_list is not None:
-        if (type(chan_list) is not list) and (type(chan_list) is not tuple):
-            assert (type(chan_list) is int)
-            chan_list = [chan_list]
-        chan_list = list(chan_list)
-    rec_list = get_rec_list(kwd_file)
-    logging.info('Will go through recs {}'.format(rec_list))
-    out_file = open(out_file_path, 'wt')
-    stored_elements = map(lambda rec_name: dset_to_binary_file(get_data_set(kwd_file, rec_name),
-                                                               out_file,
-                                                               chan_list=chan_list,
-                                                               chunk_size=chunk_size
-                                                               ),
-                          rec_list)
-    out_file.close()
-    elements_in = np.array(stored_elements).sum()
-    logging.info('{} elements written'.format(elements_in))
+    kwd_export(kwd_file, [(out_file_path, chan_list, 'dat')], chunk_size=chunk_size, zero_copy=zero_copy)
+
+
+def kwd_to_mda(kwd_file, out_file_path, chan_list=None, chunk_size=None):
+    """
+    Writes the recordings of a kwd, concatenated, to an MDA file of dims (channels, samples).
+    :param kwd_file: kwd file or kwd file
+    :param out_file_path: path to the mda file that will be created
+    :param chan_list: list of channels (must be list or tuple), in the order to write them.
+    Default (None) will do the whole table
+    :param chunk_size: size in samples of the chunk. Default (None) sizes it automatically
+    :return: dims of the mda
+    """
+    return kwd_export(kwd_file, [(out_file_path, chan_list, 'mda')], chunk_size=chunk_size)[0]
 
 
 @h5_wrap
 def get_data_size(kwd_file, rec):
     return get_data_set(kwd_file, rec).shape[0]
 
-@h5_wrap
+_rec_index_cache = {}
+
+
+def _build_rec_index(kwd_file):
+    reader = KwdReader(kwd_file, use_memmap=False)
+    return {'recordings': [int(rec) for rec in reader.rec_list],
+            'sizes': [int(size) for size in reader.rec_sizes],
+            'starts': [int(start) for start in reader.rec_starts],
+            'sample_rates': [None if fs is None else float(fs) for fs in reader.sample_rates],
+            'dtype': reader.dtype.str,
+            'n_chans': int(reader.n_chans)}
+
+
+def _load_rec_index(path, stamp):
+    sidecar = path + '.index.json'
+    try:
+        with open(sidecar, 'r') as f:
+            index = json.load(f)
+        if index.pop('stamp') == list(stamp):
+            return index
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    with h5_pool.open(path) as kwd_file:
+        index = _build_rec_index(kwd_file)
+    try:
+        with open(sidecar + '.tmp', 'w') as f:
+            json.dump(dict(index, stamp=list(stamp)), f)
+        os.rename(sidecar + '.tmp', sidecar)
+    except (IOError, OSError) as e:
+        logging.debug('could not save the recording index of {}: {}'.format(path, e))
+    return index
+
+
+def get_rec_index(kwd_file):
+    """
+    Index of the recordings of a kwd, built once per file: it is kept in memory and in a sidecar
+    <kwd>.index.json, and rebuilt when the size or modification time of the kwd change.
+    Files open for writing are indexed afresh.
+    :param kwd_file: kwd file or path to it
+    :return: dict with 'recordings' (sorted rec numbers), 'sizes' and 'starts' (np.int64 arrays, in samples),
+    'sample_rates', 'dtype' and 'n_chans'
+    """
+    if isinstance(kwd_file, h5py.File) and kwd_file.mode != 'r':
+        index = _build_rec_index(kwd_file)
+    else:
+        path = os.path.realpath(kwd_file.filename if isinstance(kwd_file, h5py.File) else kwd_file)
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime)
+        if _rec_index_cache.get(path, (None,))[0] != stamp:
+            _rec_index_cache[path] = (stamp, _load_rec_index(path, stamp))
+        index = _rec_index_cache[path][1]
+    return dict(index, sizes=np.array(index['sizes'], dtype=np.int64),
+                starts=np.array(index['starts'], dtype=np.int64))
+
+
 def get_rec_sizes(kwd_file):
-    rec_list = get_rec_list(kwd_file)
-    rec_sizes = {i: get_data_size(kwd_file, rec_list[i])
-                 for i in range(0, rec_list.size)}
-    return rec_sizes
+    rec_sizes = get_rec_index(kwd_file)['sizes']
+    return {i: int(rec_sizes[i]) for i in range(0, rec_sizes.size)}
+
 
-@h5_wrap
 def get_rec_starts(kwd_file):
-    rec_sizes= get_rec_sizes(kwd_file)
-    starts_vec = np.array(rec_sizes.values()).cumsum()
-    starts_vec = np.hstack([0, starts_vec[:-1]])
-    rec_starts = {rec: r_start for r_start, rec in zip(starts_vec, rec_sizes.iterkeys())}
-    return rec_starts
+    rec_starts = get_rec_index(kwd_file)['starts']
+    return {i: int(rec_starts[i]) for i in range(0, rec_starts.size)}
 
 def load_grp_file(grp_file_path):
     return np.loadtxt(grp_file_path, dtype={'names': ('cluster_id', 'group'), 
@@ -172,23 +718,102 @@ def load_grp_file(grp_file_path):
                       skiprows=1)
 
 # offset the recs
+class SampleIndex(object):
+    """
+    Maps sample numbers of a block (its recordings concatenated in order) to (recording, sample
+    within the recording) and back, with np.searchsorted over the recordings' starts.
+    Arrays are processed SPIKE_CHUNK elements at a time.
+    """
+
+    def __init__(self, rec_sizes, recordings=None, chunk_size=SPIKE_CHUNK):
+        """
+        :param rec_sizes: samples in each recording, in block order
+        :param recordings: number of each recording (increasing). Default (None) is 0, 1, ...
+        :param chunk_size: elements mapped at once
+        """
+        self.sizes = np.asarray(rec_sizes, dtype=np.int64)
+        self.starts = np.hstack([0, self.sizes.cumsum()[:-1]]).astype(np.int64)
+        self.n_samples = int(self.sizes.sum())
+        self.recordings = np.arange(self.sizes.size) if recordings is None else np.asarray(recordings)
+        assert self.recordings.size == self.sizes.size
+        assert np.all(np.diff(self.recordings) > 0), 'recordings have to be numbered in increasing order'
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_kwd(cls, kwd_file, **kwargs):
+        index = get_rec_index(kwd_file)
+        return cls(index['sizes'], index['recordings'], **kwargs)
+
+    def _positions(self, recording):
+        pos = np.minimum(np.searchsorted(self.recordings, recording), self.recordings.size - 1)
+        if np.any(self.recordings[pos] != recording):
+            raise ValueError('unknown recording in {}'.format(np.unique(recording)))
+        return pos
+
+    def size_of(self, recording):
+        return int(self.sizes[self._positions(recording)])
+
+    def start_of(self, recording):
+        return int(self.starts[self._positions(recording)])
+
+    def to_local(self, samples):
+        """
+        :param samples: array of sample numbers in the block
+        :return: (recording, local_sample) arrays of the same shape
+        """
+        samples = np.asarray(samples)
+        flat = samples.ravel()
+        recording = np.empty(flat.shape, dtype=self.recordings.dtype)
+        local = np.empty(flat.shape, dtype=np.int64)
+        for start in range(0, flat.size, self.chunk_size):
+            chunk = flat[start: start + self.chunk_size].astype(np.int64)
+            if chunk.size and (chunk.min() < 0 or chunk.max() >= self.n_samples):
+                raise ValueError('samples out of the block [0, {})'.format(self.n_samples))
+            # the last of equal starts, so empty recordings are skipped
+            pos = np.searchsorted(self.starts, chunk, side='right') - 1
+            recording[start: start + chunk.size] = self.recordings[pos]
+            local[start: start + chunk.size] = chunk - self.starts[pos]
+        return recording.reshape(samples.shape), local.reshape(samples.shape)
+
+    def to_global(self, recording, local_samples):
+        """
+        :param recording: array of recording numbers
+        :param local_samples: array of sample numbers within them
+        :return: array of sample numbers in the block
+        """
+        recording, local_samples = np.broadcast_arrays(np.asarray(recording), np.asarray(local_samples))
+        flat_rec = recording.ravel()
+        flat_local = local_samples.ravel()
+        samples = np.empty(flat_rec.shape, dtype=np.int64)
+        for start in range(0, flat_rec.size, self.chunk_size):
+            stop = start + self.chunk_size
+            samples[start: stop] = self.starts[self._positions(flat_rec[start: stop])] + \
+                flat_local[start: stop].astype(np.int64)
+        return samples.reshape(recording.shape)
+
+
 def ref_to_rec_starts(rec_sizes, spk_array):
-    start = 0
-    spk_rec = np.empty_like(spk_array)
-    rec_array = np.empty_like(spk_array)
-    
-    for rec, size in rec_sizes.iteritems():
-        end = start + size
-        this_rec_spk = (spk_array>start) & (spk_array<end)
-        spk_rec[this_rec_spk] = spk_array[this_rec_spk] - start
-        rec_array[this_rec_spk] = rec
-        start = end
-    
-    return rec_array, spk_rec
+    """
+    :param rec_sizes: dict {recording: size}
+    :param spk_array: sample numbers in the block
+    :return: recording and sample within it of each element of spk_array, with its dtype
+    """
+    recordings = sorted(rec_sizes.keys())
+    sample_index = SampleIndex([rec_sizes[rec] for rec in recordings], recordings)
+    rec_array, spk_rec = sample_index.to_local(spk_array)
+    return rec_array.astype(np.asarray(spk_array).dtype), spk_rec.astype(np.asarray(spk_array).dtype)
 
 def insert_table(group, table, name, attr_dict=None):
     return group.create_dataset(name, data=table)
 
+def create_spike_table(group, name, n_rows, dtype):
+    """
+    :return: 1-d dataset for n_rows values, chunked, compressed and resizable, to be filled in blocks
+    """
+    return group.create_dataset(name, shape=(n_rows,), maxshape=(None,), dtype=dtype,
+                                chunks=(max(min(n_rows, SPIKE_CHUNK_ROWS), 1),),
+                                compression='gzip', shuffle=True)
+
 def insert_group(parent_group, name, attr_dict_list=None):
     new_group = parent_group.create_group(name)
     if attr_dict_list is not None:
@@ -202,41 +827,66 @@ def append_atrributes(h5obj, attr_dict_list):
         #h5obj.attrs.create(attr['name'], attr['data'], dtype=attr['dtype'])
 
 class KwikFile:
-    def __init__(self, file_names, chan_group=0):
+    """
+    Kwik file made from the output of a sort. The spike times and clusters are not loaded:
+    they are memory-mapped (kilosort .npy, mountainsort firings.mda rows) and written
+    to the kwik SPIKE_CHUNK spikes at a time, so memory does not grow with the number of spikes.
+    """
+    def __init__(self, file_names, chan_group=0, chunk_size=SPIKE_CHUNK):
         self.file_names = file_names
+        self.chunk_size = chunk_size
 
-        if file_names['mda']:
-            spikes = readmda(file_names['mda']).astype(int)
-            self.spk = spikes[1,:] - 1 # really, 1 indexing?
-            self.clu = spikes[2,:]
+        if file_names.get('mda'):
+            firings = readmda(file_names['mda'], mmap=True)
+            self.spk = firings[1, :]
+            self.clu = firings[2, :]
+            self.one_indexed = True # really, 1 indexing?
             with open(file_names['param'], 'r') as f:
                 params = json.load(f)
             self.s_f = params['samplerate']
 
         else: # its a kilosort conversion
+            self.one_indexed = False
             if file_names['clu']:
-                self.clu = np.squeeze(np.load(file_names['clu']))
+                self.clu = np.load(file_names['clu'], mmap_mode='r').ravel()
             elif file_names['temp']:
-                self.clu = np.squeeze(np.load(file_names['temp']))
+                self.clu = np.load(file_names['temp'], mmap_mode='r').ravel()
             else:
                 raise IOError('both spike_clusters.npy and spike_templates.npy weren\'t found')
-            self.spk = np.load(file_names['spk'])
-            
+            self.spk = np.load(file_names['spk'], mmap_mode='r').ravel()
             with open(file_names['par'], 'r') as f:
                 exec(f.read())
                 self.s_f = sample_rate
+
+        assert self.spk.size == self.clu.size, 'spike times and clusters differ in length'
+        self.n_spikes = self.spk.size
         
         if 'grp' in file_names and file_names['grp']:
             self.grp = load_grp_file(file_names['grp'])
         else:
-            self.grp = [(i, 'unsorted') for i in np.unique(self.clu)]
+            self.grp = [(i, 'unsorted') for i in self.unique_clusters()]
 
-        self.rec_kwik = None
-        self.spk_kwik = None
+        self.recordings = None
+        self.sample_index = None
         self.kwf = None
         self.chan_group = chan_group
         self.create_kwf()
-        
+
+    def iter_spikes(self):
+        """
+        :return: iterator over blocks of (spike sample in the block as np.uint64, cluster as np.uint32)
+        """
+        for start in range(0, self.n_spikes, self.chunk_size):
+            spk = self.spk[start: start + self.chunk_size].astype(np.uint64)
+            if self.one_indexed:
+                spk -= 1
+            yield spk, self.clu[start: start + self.chunk_size].astype(np.uint32)
+
+    def unique_clusters(self):
+        clusters = np.array([], dtype=np.uint32)
+        for _, clu in self.iter_spikes():
+            clusters = np.union1d(clusters, clu)
+        return clusters
         
     def create_kwf(self):
         with h5py.File(self.file_names['kwk'], 'w') as kwf:
@@ -244,27 +894,41 @@ class KwikFile:
             kwf.create_group('/recordings')
         
     def make_spk_tables(self, realign_to_recordings=True):
-        with h5py.File(self.file_names['kwd'], 'r') as kwd:
-            rec_sizes = get_rec_sizes(kwd)
-            self.rec_kwik, self.spk_kwik = ref_to_rec_starts(rec_sizes, self.spk)
+        self.sample_index = SampleIndex.from_kwd(self.file_names['kwd'], chunk_size=self.chunk_size)
+        recordings = set()
         
         with h5py.File(self.file_names['kwk'], 'r+') as kwf:
             chan_group = kwf['/channel_groups'].require_group('{}'.format(self.chan_group))
             spikes_group = chan_group.require_group('spikes')
-            insert_table(spikes_group, self.rec_kwik.flatten(), 'recording')
-            if realign_to_recordings:
-                insert_table(spikes_group, self.spk_kwik.flatten() , 'time_samples')
-                insert_table(spikes_group, self.spk_kwik.flatten() /self.s_f, 'time_fractional')
-            else:
-                insert_table(spikes_group, self.spk.flatten() , 'time_samples')
-    
             clusters_group = spikes_group.require_group('clusters')
-            insert_table(clusters_group, self.clu, 'main')
-            insert_table(clusters_group, self.clu, 'original')
+            tables = {'recording': create_spike_table(spikes_group, 'recording', self.n_spikes, np.uint16),
+                      'time_samples': create_spike_table(spikes_group, 'time_samples', self.n_spikes, np.uint64),
+                      'main': create_spike_table(clusters_group, 'main', self.n_spikes, np.uint32),
+                      'original': create_spike_table(clusters_group, 'original', self.n_spikes, np.uint32)}
+            if realign_to_recordings:
+                tables['time_fractional'] = create_spike_table(spikes_group, 'time_fractional', self.n_spikes,
+                                                               np.float64)
+
+            start = 0
+            for spk, clu in self.iter_spikes():
+                stop = start + spk.size
+                rec, spk_rec = self.sample_index.to_local(spk)
+                recordings.update(np.unique(rec).tolist())
+                tables['recording'][start:stop] = rec
+                if realign_to_recordings:
+                    tables['time_samples'][start:stop] = spk_rec
+                    tables['time_fractional'][start:stop] = spk_rec / self.s_f
+                else:
+                    tables['time_samples'][start:stop] = spk
+                tables['main'][start:stop] = clu
+                tables['original'][start:stop] = clu
+                start = stop
+        self.recordings = np.array(sorted(recordings), dtype=np.int64)
     
     def make_rec_groups(self):
-        rec_list = np.unique(self.rec_kwik)
-        rec_start_samples = get_rec_starts(self.file_names['kwd'])
+        rec_list = self.recordings
+        if self.sample_index is None:
+            self.sample_index = SampleIndex.from_kwd(self.file_names['kwd'])
         
         with h5py.File(self.file_names['kwk'], 'r+') as kwf:
             rec_group = kwf.require_group('recordings')
@@ -272,8 +936,8 @@ class KwikFile:
                 rec_name = 'recording_{}'.format(rec)
                 attribs = [{'name': 'name', 'data': rec_name, 'dtype': 'S{}'.format(len(rec_name))}, 
                           {'name': 'sample_rate', 'data': self.s_f, 'dtype': np.dtype(np.float64)},
-                          {'name': 'start_sample', 'data': rec_start_samples[rec], 'dtype': np.int64},
-                          {'name': 'start_time', 'data': rec_start_samples[rec]/self.s_f, 'dtype': np.float64}]
+                          {'name': 'start_sample', 'data': self.sample_index.start_of(rec), 'dtype': np.int64},
+                          {'name': 'start_time', 'data': self.sample_index.start_of(rec)/self.s_f, 'dtype': np.float64}]
                 insert_group(rec_group, str(rec), attribs)
     
     def make_clu_groups(self, name='main'):
@@ -4,11 +4,9 @@
 import argparse
 import os
 import glob
-import h5py as h5
-import numpy as np
 import datetime
 import resource
-from mdaio import writemda16i
+from h5_util import kwd_to_mda
 
 
 def get_args():
@@ -17,6 +15,9 @@ def get_args():
                         help='directory containing the *.raw.kwd file to extract')
     parser.add_argument('dest', default='./', nargs='?',
                         help='destination directory for raw.mda file')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='number of samples per chunk, default is sized from the available memory '
+                             'and the hdf5 chunk shape')
     return parser.parse_args()
 
 
@@ -31,25 +32,8 @@ def main():
     kwd = glob.glob(os.path.join(path, '*.raw.kwd'))[0]
     out_mda = os.path.join(dest, 'raw.mda')
 
-    n_chans = -1
-    n_samples = 0
-    with h5.File(kwd, 'r') as kwd_f:
-        recordings = np.sort(np.array(kwd_f['recordings'].keys(), dtype=int)).astype('unicode')
-        for recording in recordings:
-            assert n_chans == -1 or n_chans == kwd_f['recordings'][recording]['data'].shape[1]
-            n_chans = kwd_f['recordings'][recording]['data'].shape[1]
-            n_samples += kwd_f['recordings'][recording]['data'].shape[0]
-        print "total number of samples %d" % (n_samples)
-        data = np.empty((n_samples, n_chans), dtype='int16')
-        idx = 0
-        for recording in recordings:
-            rec_len = kwd_f['recordings'][recording]['data'].shape[0]
-            print "loading recording %s with length of %d" % (recording, rec_len)
-            data[idx:idx + rec_len, :] = kwd_f['recordings'][recording]['data']
-            idx += rec_len
-
-    print "writing data"
-    writemda16i(data.T, out_mda)
+    dims = kwd_to_mda(kwd, out_mda, chunk_size=args.chunk_size)
+    print "wrote %d channels, %d samples" % tuple(dims)
 
     print 'peak memory usage: %f GB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. / 1024.)
     print 'time elapsed: %s' % (datetime.datetime.now() - tstart)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""exports a kwd to the inputs of several sorters (kilosort .dat, mountainsort raw.mda, channel subsets)
+reading the kwd only once
+"""
+import argparse, os, glob
+import datetime, resource
+from h5_util import kwd_export
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export a KWD file to several flat binary and MDA files '
+                                                 'in one pass over the data.')
+    parser.add_argument('path', default='./', nargs='?',
+                        help='directory containing the *.raw.kwd file to extract')
+    parser.add_argument('dest', default='./', nargs='?',
+                        help='destination directory for the exported files')
+    parser.add_argument('--dat', dest='dat', action='store_true',
+                        help='write the .dat file for kilosort')
+    parser.add_argument('--mda', dest='mda', action='store_true',
+                        help='write raw.mda for mountainsort')
+    parser.add_argument('--subset', dest='subsets', action='append', default=[], metavar='FILE=CHANS',
+                        help='also write the comma-separated channels CHANS, in that order, to FILE '
+                             '(an MDA file if it ends in .mda, else flat binary). can be repeated')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='number of samples per chunk, default is sized from the available memory '
+                             'and the hdf5 chunk shape')
+    return parser.parse_args()
+
+
+def parse_subset(subset, dest):
+    file_name, chans = subset.split('=')
+    chan_list = [int(i) for i in chans.split(',')]
+    file_format = 'mda' if file_name.endswith('.mda') else 'dat'
+    return os.path.join(dest, file_name), chan_list, file_format
+
+
+def main():
+    args = get_args()
+    tstart = datetime.datetime.now()
+
+    path = os.path.abspath(args.path)
+    dest = os.path.abspath(args.dest)
+
+    assert len(glob.glob(os.path.join(path, '*.raw.kwd'))) == 1, "Error finding .raw.kwd file in {}".format(path)
+    kwd = glob.glob(os.path.join(path, '*.raw.kwd'))[0]
+    name = os.path.split(kwd)[-1].split('.')[0]
+
+    exports = []
+    if args.dat or not (args.mda or args.subsets):
+        exports.append((os.path.join(dest, name + '.dat'), None, 'dat'))
+    if args.mda or not (args.dat or args.subsets):
+        exports.append((os.path.join(dest, 'raw.mda'), None, 'mda'))
+    exports += [parse_subset(subset, dest) for subset in args.subsets]
+    for out_file, chan_list, file_format in exports:
+        print "{} ({}): {}".format(out_file, file_format, 'all channels' if chan_list is None else chan_list)
+
+    kwd_export(kwd, exports, chunk_size=args.chunk_size)
+
+    print 'peak memory usage: %f GB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. / 1024.)
+    print 'time elapsed: %s' % (datetime.datetime.now() - tstart)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,18 @@
 import os
 import argparse
 import glob
+import itertools
+from multiprocessing import Pool
 import numpy as np
+import h5py as h5
 import datetime, resource
+from klusta_pipeline import WINDOW_SAMPLES, CHUNK_ROWS
 from klusta_pipeline.maps import port_site
-from klusta_pipeline.dataio import load_recordings, load_catlog
-from klusta_pipeline.dataio import save_info, save_recording, save_chanlist, save_probe, save_parameters
-from klusta_pipeline.utils import get_import_list, validate_merge, realign, calc_weights, do_inplace_chunked_war, do_car, realign_methods
+from klusta_pipeline.dataio import load_recordings, index_recordings, load_catlog, RecordingWriter
+from klusta_pipeline.dataio import save_info, write_recording, save_chanlist, save_probe, save_parameters
+from klusta_pipeline.utils import get_import_list, validate_merge, realign, calc_weights, do_inplace_war, do_inplace_chunked_car, realign_methods
+from klusta_pipeline.utils import iter_chunks
+from klusta_pipeline.preprocess import get_preprocessor
 from klusta_pipeline.probe import get_channel_groups, clean_dead_channels, build_geometries
 
 # assume spike2 export to mat with the following parameters:
@@ -35,12 +41,146 @@ def get_args():
                        help='comma-separate list of channel labels to drop if they exist')
     parser.add_argument('-a','--align',dest='realignment',type=str, default='spline', 
                        help='sets realignment method. Options include: %s' % (str(realign_methods.keys())))
+    parser.add_argument('--stream',dest='stream',action='store_true',
+                       help='streams each recording into the kwd in windows instead of holding the whole block in memory')
+    parser.add_argument('--window',dest='window',type=int,default=WINDOW_SAMPLES,
+                       help='number of samples per window in --stream mode and when filtering. Defaults to %i' % WINDOW_SAMPLES)
+    parser.add_argument('--highpass',dest='highpass',type=float,default=None,
+                       help='high pass corner (Hz) of the band-pass applied while building the kwd. Defaults to None (no filtering)')
+    parser.add_argument('--lowpass',dest='lowpass',type=float,default=None,
+                       help='low pass corner (Hz) of the band-pass applied while building the kwd. Defaults to None (no filtering)')
+    parser.add_argument('--notch',dest='notch',type=str,default='',
+                       help='comma-separated list of line noise frequencies (Hz) to notch out while building the kwd')
+    parser.add_argument('--filter-order',dest='filter_order',type=int,default=3,
+                       help='order of the Butterworth band-pass. Defaults to 3')
+    parser.add_argument('--fir-taps',dest='fir_taps',type=int,default=0,
+                       help='use a linear-phase FIR band-pass with this many taps instead of the Butterworth')
+    parser.add_argument('--chunk-rows',dest='chunk_rows',type=int,default=None,
+                       help='samples per hdf5 chunk of the recordings. Defaults to contiguous storage, or %i when streaming or compressing' % CHUNK_ROWS)
+    parser.add_argument('--compression',dest='compression',type=str,default='none',choices=['none','gzip','lzf'],
+                       help='lossless compression of the recordings. gzip chunks are compressed in parallel. Defaults to none')
+    parser.add_argument('--compression-level',dest='compression_level',type=int,default=4,
+                       help='gzip compression level. Defaults to 4')
+    parser.add_argument('--shuffle',dest='shuffle',action='store_true',
+                       help='byte-shuffles chunks before compressing them')
+    parser.add_argument('--threads',dest='threads',type=int,default=None,
+                       help='threads compressing gzip chunks. Defaults to the number of cpus')
+    parser.add_argument('-j','--jobs',dest='jobs',type=int,default=1,
+                       help='number of processes loading and realigning .mat files in parallel. Defaults to 1')
     parser.add_argument('--upper',dest='upper_thresh',type=float,default=4.5,help='Sets the upper threshold in std for spike detektion')
     parser.add_argument('--lower',dest='lower_thresh',type=float,default=2,help='Sets the lower threshold in std for spike detektion')
     parser.add_argument('--prespike',dest='prespike',type=float, default=0.8,help='Sets the time in milliseconds to take prior to spike peak')
     parser.add_argument('--postspike',dest='postspike',type=float,default=1.5,help='Sets the time in milliseconds to take after spike peak')
     return parser.parse_args()
 
+def kwd_layout(args,stream=False):
+    '''storage options for the recordings/N/data datasets.
+    streamed datasets are resizable, so they are always chunked
+    '''
+    compression = None if args.compression=='none' else args.compression
+    chunk_rows = args.chunk_rows
+    if chunk_rows is None and (stream or compression):
+        chunk_rows = CHUNK_ROWS
+    return dict(chunk_rows=chunk_rows,compression=compression,shuffle=args.shuffle,
+                level=args.compression_level,threads=args.threads)
+
+def load_file(import_file,chans,fs,args):
+    '''loads, realigns and filters every recording in one .mat file, removing each recording's mean'''
+    rec_list = []
+    preprocessor = get_preprocessor(args,fs)
+    for r in load_recordings(import_file,chans, inc_times=(args.realignment=='spline')):
+        rec = realign(r,chans,fs,args.realignment)
+        if preprocessor:
+            preprocessor.filter_inplace(rec['data'],window=args.window)
+        rec['data'] -= rec['data'].mean(axis=0).astype(np.int16)
+        rec_list.append(rec)
+    return rec_list
+
+def stream_file(kwd_f,import_file,chans,fs,args,index=0):
+    '''realigns every recording in one .mat file straight into kwd_f, window by window,
+    numbering the recordings from `index`. any filtering happens on the way in;
+    the mean is removed (and CAR applied) in a second windowed pass.
+    'data' of the returned recordings is the dataset.
+    '''
+    rec_list = []
+    preprocessor = get_preprocessor(args,fs)
+    print 'Loading %s' % import_file
+    with h5.File(import_file, 'r') as f:
+        recordings = index_recordings(f,chans, inc_times=(args.realignment=='spline'), window=args.window)
+        for r in recordings:
+            r.update(file_origin=import_file)
+            rec = realign(r,chans,fs,args.realignment,stream=True,window=args.window)
+            writer = RecordingWriter(kwd_f,index+len(rec_list),len(chans),**kwd_layout(args,stream=True))
+            blocks = preprocessor.filter_blocks(rec['data']) if preprocessor else rec['data']
+            for block in blocks:
+                writer.write(block)
+            writer.flush()
+            rec['data'] = writer.dset
+
+            offset = writer.mean().astype(np.int16)
+            for start, stop in iter_chunks(rec['data'].shape[0],args.window):
+                block = rec['data'][start:stop]
+                block -= offset
+                if args.car and not args.weighted:
+                    do_inplace_chunked_car(block)
+                writer.write_at(start,block)
+            writer.close()
+            rec_list.append(rec)
+    return rec_list
+
+def _load_job(job):
+    # the recordings go back through a part file: pickling them doubles the parent's
+    # memory for a moment and fails past 2 GiB
+    part, import_file, chans, fs, args = job
+    rec_list = load_file(import_file,chans,fs,args)
+    with h5.File(part, 'w') as part_f:
+        for ii, rec in enumerate(rec_list):
+            part_f.create_dataset('recordings/%i/data' % ii, data=rec.pop('data'))
+    return rec_list
+
+def _stream_job(job):
+    # each worker streams into its own part file; the parent copies them in order
+    part, import_file, chans, fs, args = job
+    with h5.File(part, 'w') as part_f:
+        rec_list = stream_file(part_f,import_file,chans,fs,args)
+    return [{k:v for k,v in rec.items() if k != 'data'} for rec in rec_list]
+
+def ingest(kwd,import_list,chans,fs,args):
+    '''loads and realigns all the .mat files, in a pool of args.jobs processes if > 1.
+    recordings are numbered in import_list order regardless of which worker finishes first.
+    in --stream mode, returns the open kwd file whose datasets are the recordings' 'data'.
+    workers hand their recordings back through part files next to the kwd.
+    '''
+    pool = Pool(args.jobs) if args.jobs > 1 else None
+    kwd_f = h5.File(kwd, 'a') if args.stream else None
+    rec_list = []
+    if pool is None:
+        for import_file in import_list:
+            if args.stream:
+                rec_list += stream_file(kwd_f,import_file,chans,fs,args,index=len(rec_list))
+            else:
+                rec_list += load_file(import_file,chans,fs,args)
+    else:
+        parts = [kwd+'.part%i' % ii for ii in range(len(import_list))]
+        jobs = [(part,import_file,chans,fs,args) for part, import_file in zip(parts,import_list)]
+        results = pool.imap(_stream_job if args.stream else _load_job, jobs)
+        for part, recordings in itertools.izip(parts, results):
+            with h5.File(part, 'r') as part_f:
+                for ii, rec in enumerate(recordings):
+                    if args.stream:
+                        path = 'recordings/%i' % len(rec_list)
+                        print ' copying %s...' % path
+                        part_f.copy('recordings/%i' % ii, kwd_f, name=path)
+                        rec['data'] = kwd_f[path+'/data']
+                    else:
+                        rec['data'] = part_f['recordings/%i/data' % ii][:]
+                    rec_list.append(rec)
+            os.remove(part)
+    if pool:
+        pool.close()
+        pool.join()
+    return kwd_f, rec_list
+
 def main():
     args = get_args()
     tstart = datetime.datetime.now()
@@ -102,27 +242,24 @@ def main():
     }
     save_parameters(info['params'],dest)
     
-    rec_list = []
-    # print import_list
-    for import_file in import_list:
-        recordings = load_recordings(import_file,chans, inc_times=(args.realignment is 'spline'))
-        for r in recordings:
-            rec = realign(r,chans,fs,args.realignment)
-            rec['data'] -= rec['data'].mean(axis=0).astype(np.int16)
-            rec_list.append(rec)
-    del recordings
-    info['recordings'] = [{k:v for k,v in rec.items() if k is not 'data'} for rec in rec_list]
+    kwd_f, rec_list = ingest(kwd,import_list,chans,fs,args)
+    if kwd_f is None:
+        kwd_f = h5.File(kwd, 'a')
+    info['recordings'] = [{k:v for k,v in rec.items() if k != 'data'} for rec in rec_list]
     save_info(dest,info)
 
     weights = calc_weights(rec_list) if args.weighted else None
 
     for indx, rec in enumerate(rec_list):
         if args.weighted:
-            do_inplace_chunked_war(rec['data'], weights)
-        elif args.car:
-            rec['data'] = do_car(rec['data'])
+            do_inplace_war(rec['data'], weights)
+        elif args.car and not args.stream:
+            do_inplace_chunked_car(rec['data'])
+
+        if not args.stream:
+            write_recording(kwd_f,rec,indx,**kwd_layout(args))
 
-        save_recording(kwd,rec,indx)
+    kwd_f.close()
 
     print 'peak memory usage: %f GB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. / 1024.)
     print 'time: %s' % (datetime.datetime.now() - tstart)
@@ -2,7 +2,9 @@
 source: https://github.com/flatironinstitute/mountainsort/blob/master/packages/pyms/mlpy/mdaio.py
 '''
 
+import os
 import struct
+import threading
 import numpy as np
 
 
@@ -22,6 +24,10 @@ class MdaHeader:
             self.header_size=(3+self.num_dims)*4
 
 class DiskReadMda:
+    """Reads an mda through one read-only memory map of the file, made on first use.
+    Chunks are views of the map (no copy); any range of the first dimension can be read,
+    so channel subsets of a (channels x samples) array are cheap.
+    """
     def __init__(self,path,header=None):
         self._path=path
         if header:
@@ -29,6 +35,7 @@ class DiskReadMda:
             self._header.header_size=0
         else:
             self._header=_read_header(self._path)            
+        self._mmap=None
     def dims(self):
         return self._header.dims
     def N1(self):
@@ -39,48 +46,63 @@ class DiskReadMda:
         return int(self._header.dims[2])
     def dt(self):
         return self._header.dt
+    def array(self):
+        """the whole array as a read-only np.memmap, in Fortran order"""
+        if self._mmap is None:
+            self._mmap=_memmap(self._path,self._header)
+        return self._mmap
+    def close(self):
+        self._mmap=None
     def readChunk(self,i1=-1,i2=-1,i3=-1,N1=1,N2=1,N3=1):
         #print("Reading chunk {} {} {} {} {} {}".format(i1,i2,i3,N1,N2,N3))
         if (i2<0):
             return self._read_chunk_1d(i1,N1)
-        elif (i3<0):
-            if N1 != self._header.dims[0]:
-                print ("Unable to support N1 {} != {}".format(N1,self._header.dims[0]))
-                return None
-            X=self._read_chunk_1d(i1+N1*i2,N1*N2)
-            return np.reshape(X,(N1,N2),order='F')
+        X=self.array()
+        if (i3<0):
+            # trailing dims read as one, as in the file
+            X=X.reshape((X.shape[0],-1),order='F')
+            return X[i1:i1+N1,i2:i2+N2]
         else:
-            if N1 != self._header.dims[0]:
-                print ("Unable to support N1 {} != {}".format(N1,self._header.dims[0]))
-                return None
-            if N2 != self._header.dims[1]:
-                print ("Unable to support N2 {} != {}".format(N2,self._header.dims[1]))
-                return None
-            X=self._read_chunk_1d(i1+N1*i2+N1*N2*i3,N1*N2*N3)
-            return np.reshape(X,(N1,N2,N3),order='F')
+            return X[i1:i1+N1,i2:i2+N2,i3:i3+N3]
+    def readChannels(self,channels,i2,N2):
+        """samples i2 to i2+N2 of the rows (channels) listed, in that order. a copy"""
+        return self.array()[np.asarray(channels),i2:i2+N2]
     def _read_chunk_1d(self,i,N):
-        f=open(self._path,"rb")
-        try:
-            f.seek(self._header.header_size+self._header.num_bytes_per_entry*i)
-            ret=np.fromfile(f,dtype=self._header.dt,count=N)
-            f.close()
-            return ret
-        except Exception as e: # catch *all* exceptions
-            print (e)
-            f.close()
-            return None
+        X=self.array()
+        return X.reshape(X.size,order='F')[i:i+N]
 
 class DiskWriteMda:
-    def __init__(self,path,dims,dt='float64'):
+    """Writes an mda in chunks, in any order. The file is created at its full size with the header,
+    and kept open; each chunk is written at its own offset (os.pwrite where available), so
+    several threads, or processes with their own DiskWriteMda(..., create=False), can write at once.
+    """
+    def __init__(self,path,dims,dt='float64',create=True):
         self._path=path
         self._header=MdaHeader(dt,dims)
-        _write_header(path, self._header)
+        if create:
+            _write_header(path, self._header)
+        else:
+            H=_read_header(path)
+            assert H is not None and list(H.dims)==list(dims) and H.dt==dt, 'header of {} does not match'.format(path)
+            self._header=H
+        self._fd=os.open(path,os.O_RDWR)
+        if create:
+            os.ftruncate(self._fd,self._header.header_size+self._header.num_bytes_per_entry*int(self._header.dimprod))
+        self._lock=threading.Lock()
     def N1(self):
         return self._header.dims[0]
     def N2(self):
         return self._header.dims[1]
     def N3(self):
         return self._header.dims[2]
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd=None
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc_info):
+        self.close()
     def writeChunk(self,X,i1=-1,i2=-1,i3=-1):
         #print("Writing chunk {} {} {} {}".format(i1,i2,i3,X[0]))
         if (len(X.shape)>=2):
@@ -101,7 +123,7 @@ class DiskWriteMda:
             if N1 != self._header.dims[0]:
                 print ("Unable to support DiskWriteMda N1 {} != {}".format(N1,self._header.dims[0]))
                 return None
-            return self._write_chunk_1d(X.ravel(order='F'),i1+N1*i2)
+            return self._write_chunk_1d(X,i1+N1*i2)
         else:
             if N1 != self._header.dims[0]:
                 print ("Unable to support DiskWriteMda N1 {} != {}".format(N1,self._header.dims[0]))
@@ -109,21 +131,30 @@ class DiskWriteMda:
             if N2 != self._header.dims[1]:
                 print ("Unable to support DiskWriteMda N2 {} != {}".format(N2,self._header.dims[1]))
                 return None
-            return self._write_chunk_1d(X.ravel(order='F'),i1+N1*i2+N1*N2*i3)
+            return self._write_chunk_1d(X,i1+N1*i2+N1*N2*i3)
     def _write_chunk_1d(self,X,i):
-        N=X.size
-        f=open(self._path,"ab")
+        # no copy when X already has the file's dtype and is Fortran-contiguous (e.g. a transposed kwd chunk)
+        A=np.asarray(X,dtype=self._header.dt).ravel(order='F')
+        data=memoryview(A.view(np.uint8))
+        offset=self._header.header_size+self._header.num_bytes_per_entry*i
         try:
-            #print('Writing data to file at position {} values: {}'.format(self._header.header_size+self._header.num_bytes_per_entry*i,X))
-            f.seek(self._header.header_size+self._header.num_bytes_per_entry*i)
-            X.astype(self._header.dt).tofile(f)
-            f.close()
+            while len(data)>0:
+                n=_pwrite(self._fd,data,offset,self._lock)
+                data=data[n:]
+                offset+=n
             return True
         except Exception as e: # catch *all* exceptions
             print (e)
-            f.close()
             return False
 
+def _pwrite(fd,data,offset,lock):
+    if hasattr(os,'pwrite'):
+        return os.pwrite(fd,data,offset)
+    # threads sharing the descriptor take turns to seek and write
+    with lock:
+        os.lseek(fd,offset,os.SEEK_SET)
+        return os.write(fd,data)
+
 def _dt_from_dt_code(dt_code):
     if dt_code == -2:
         dt='uint8'
@@ -207,9 +238,12 @@ def _read_header(path):
             print ("Invalid data type code: {}".format(dt_code))
             return None
         H=MdaHeader(dt,dims)
+        # the header says how wide its dims are, whatever their values
+        H.uses64bitdims=uses64bitdims
         if (uses64bitdims):
-            H.uses64bitdims=True
             H.header_size=3*4+H.num_dims*8
+        else:
+            H.header_size=(3+H.num_dims)*4
         f.close()
         return H
     except Exception as e: # catch *all* exceptions
@@ -237,11 +271,22 @@ def _write_header(path,H):
         f.close()
         return False
 
-def readmda(path):
+def _memmap(path,H):
+    shape=tuple(int(d) for d in H.dims)
+    if np.prod(shape)==0:
+        return np.zeros(shape,dtype=H.dt,order='F')
+    return np.memmap(path,dtype=H.dt,mode='r',offset=H.header_size,shape=shape,order='F')
+
+def readmda(path,mmap=False):
+    """the array in an mda file. with mmap=True, a read-only np.memmap (Fortran order) of it
+    instead of a copy in memory, so only the pages used are read
+    """
     H=_read_header(path)
     if (H is None):
         print ("Problem reading header of: {}".format(path))
         return None
+    if mmap:
+        return _memmap(path,H)
     ret=np.array([])
     f=open(path,"rb")
     try:
@@ -329,6 +374,7 @@ def mdaio_test():
 
     A=DiskWriteMda('tmpA.mda',(M,N))
     A.writeChunk(Y,i1=0,i2=0)
+    A.close()
     B=readmda('tmpA.mda')
     print (B.shape)
     print (B)
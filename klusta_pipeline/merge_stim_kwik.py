@@ -1,7 +1,6 @@
 
 # Merge stimuli information from spike2 mat file into Kwik file
 
-import h5py as h5
 import tables
 import os
 import numpy as np
@@ -11,8 +10,10 @@ import glob
 try: import simplejson as json
 except ImportError: import json
 
-from klusta_pipeline.dataio import load_recordings, save_info, load_digmark, load_stim_info
-from klusta_pipeline.utils import get_import_list, validate_merge, realign
+from klusta_pipeline.dataio import load_recording_index, save_info, load_digmark, load_stim_info
+from klusta_pipeline.utils import get_import_list, validate_merge, recording_info
+from klusta_pipeline.h5_util import SampleIndex
+from klusta_pipeline import SPIKE_CHUNK
 
 def get_args():
 
@@ -23,9 +24,41 @@ def get_args():
                        help='destination directory for kwd and other files')
     return parser.parse_args()
 
-def get_rec_samples(kwd_file,index):
-    with h5.File(kwd_file, 'r') as kwd:
-        return kwd['/recordings/{}/data'.format(index)].shape[0]
+def sort_events(times, **columns):
+    '''events as a dict of arrays ('times' and the given columns), sorted by time'''
+    times = np.atleast_1d(times)
+    order = np.argsort(times, kind='mergesort')
+    events = {k: np.atleast_1d(v)[order] for k, v in columns.items()}
+    events['times'] = times[order]
+    return events
+
+def load_event_tables(s2mat):
+    '''DigMark and Stimulus events of a spike2 .mat file, each sorted by time'''
+    codes, times = load_digmark(s2mat)
+    digmark = sort_events(times, codes=codes)
+    codes, times, names = load_stim_info(s2mat)
+    stimulus = sort_events(times, codes=codes, text=names)
+    return {'DigMark': digmark, 'Stimulus': stimulus}
+
+def event_window(events, t0, dur):
+    '''the events with t0 <= time < t0+dur'''
+    start, stop = np.searchsorted(events['times'], [t0, t0+dur], side='left')
+    return {k: v[start:stop] for k, v in events.items()}
+
+def rehome_spikes(recording_node, time_samples_node, sample_index, chunk_size=SPIKE_CHUNK):
+    '''rewrites, in place and chunk_size spikes at a time, the block sample numbers in time_samples_node
+    as (recording, sample within it) in recording_node and time_samples_node.
+    returns the number of spikes that were past the first recording
+    '''
+    moved = 0
+    for start in range(0, time_samples_node.nrows, chunk_size):
+        stop = min(start + chunk_size, time_samples_node.nrows)
+        time_samples = time_samples_node[start:stop]
+        recording, local = sample_index.to_local(time_samples)
+        moved += (local != time_samples).sum()
+        recording_node[start:stop] = recording.astype(recording_node.dtype)
+        time_samples_node[start:stop] = local.astype(time_samples_node.dtype)
+    return int(moved)
 
 def merge_recording_info(klu_path,mat_path):
     batch = klu_path.split('__')[-1]
@@ -49,15 +82,13 @@ def merge_recording_info(klu_path,mat_path):
     for i,m in zip(info['exports'],mat_data):
         i['chans'] = chans
 
+    # only the boundaries and start times are needed, not the realigned data
     rec_list = []
     for import_file in import_list:
-        recordings = load_recordings(import_file,chans)
-        for r in recordings:
-            rec = realign(r,chans,fs,'spline')
-            del rec['data']
-            rec_list.append(rec)
+        for r in load_recording_index(import_file,chans):
+            rec_list.append(recording_info(r,chans,fs))
 
-    info['recordings'] = [{k:v for k,v in rec.items() if k is not 'data'} for rec in rec_list]
+    info['recordings'] = rec_list
     save_info(klu_path,info)
     return info
 
@@ -71,6 +102,8 @@ def merge(spike2mat_folder, kwik_folder):
     kwik_data_file = os.path.join(kwik_folder,info['name']+'.kwik')
     kwd_raw_file = os.path.join(kwik_folder,info['name']+'.raw.kwd')\
 
+    sample_index = SampleIndex.from_kwd(kwd_raw_file)
+
     with tables.open_file(kwik_data_file, 'r+') as kkfile:
 
         digmark_timesamples = []
@@ -84,38 +117,19 @@ def merge(spike2mat_folder, kwik_folder):
         spike_recording_obj = kkfile.get_node('/channel_groups/0/spikes','recording')
         spike_time_samples_obj = kkfile.get_node('/channel_groups/0/spikes','time_samples')
 
-        spike_recording = spike_recording_obj.read()
-        spike_time_samples = spike_time_samples_obj.read()
-
         try:
             assert 'recordings' in info
         except AssertionError:
             info = merge_recording_info(kwik_folder,spike2mat_folder)
 
 
-        order = np.sort([str(ii) for ii in range(len(info['recordings']))])
-        print order
-	print len(spike_recording)
-        is_done = np.zeros(spike_recording.shape,np.bool_)
-        for rr,rid_str in enumerate(order):
-            # rr: index of for-loop
+        # recordings cut from the same .mat file share its events, decoded once
+        event_tables = {}
+        for rid in range(len(info['recordings'])):
             # rid: recording id
-            # rid_str: string form of recording id
-            rid = int(rid_str)
             rec = info['recordings'][rid]
 
-            n_samps = get_rec_samples(kwd_raw_file,rid)
-
-            #is_done = np.vectorize(lambda x: x not in done)
-
-            todo = ~is_done & (spike_time_samples >= n_samps)
-            print "rec {}: {} spikes done".format(rid,is_done.sum())
-            print "setting {} spikes to next cluster".format(todo.sum())
-            if todo.sum()>0:
-                spike_recording[todo] = int(order[rr+1])
-                spike_time_samples[todo] -= n_samps
-            is_done = is_done | ~todo
-            print is_done.sum()
+            n_samps = sample_index.size_of(rid)
 
             t0 = rec['start_time']
             fs = rec['fs']
@@ -124,11 +138,12 @@ def merge(spike2mat_folder, kwik_folder):
             s2mat = os.path.split(rec['file_origin'])[-1]
             s2mat = os.path.join(spike2mat_folder, s2mat)
 
-            codes, times = load_digmark(s2mat)
-            rec_mask = (times >= t0) * (times < (t0+dur))
+            if s2mat not in event_tables:
+                event_tables[s2mat] = load_event_tables(s2mat)
 
-            codes = codes[rec_mask]
-            times = times[rec_mask] - t0
+            digmark = event_window(event_tables[s2mat]['DigMark'], t0, dur)
+            codes = digmark['codes']
+            times = digmark['times'] - t0
             time_samples = (times * fs).round().astype(np.uint64)
             recording = rid * np.ones(codes.shape,np.uint16)
 
@@ -136,12 +151,10 @@ def merge(spike2mat_folder, kwik_folder):
             digmark_recording.append(recording)
             digmark_codes.append(codes)
 
-            codes, times, names = load_stim_info(s2mat)
-            rec_mask = (times >= t0) * (times < (t0+dur))
-
-            codes = codes[rec_mask]
-            names = names[rec_mask]
-            times = times[rec_mask] - t0
+            stimulus = event_window(event_tables[s2mat]['Stimulus'], t0, dur)
+            codes = stimulus['codes']
+            names = stimulus['text']
+            times = stimulus['times'] - t0
             time_samples = (times * fs).round().astype(np.uint64)
             recording = rid * np.ones(codes.shape,np.uint16)
 
@@ -180,8 +193,9 @@ def merge(spike2mat_folder, kwik_folder):
         kkfile.create_earray("/event_types/Stimulus", 'codes', obj=stimulus_codes)
         kkfile.create_earray("/event_types/Stimulus", 'text', obj=stimulus_names)
 
-        spike_recording_obj[:] = spike_recording
-        spike_time_samples_obj[:] = spike_time_samples
+        # kilo2kwik and mda2kwik leave spike times counted from the start of the block
+        moved = rehome_spikes(spike_recording_obj, spike_time_samples_obj, sample_index)
+        print "moved {} of {} spikes out of the first recording".format(moved, spike_time_samples_obj.nrows)
 
 
 def main():
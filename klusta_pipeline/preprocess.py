@@ -0,0 +1,112 @@
+# Chunked filtering of realigned recordings, so the expensive filtering is done once, in make_kwd
+
+import itertools
+import numpy as np
+from scipy import signal
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from klusta_pipeline import WINDOW_SAMPLES
+from klusta_pipeline.utils import iter_chunks
+
+
+class Preprocessor(object):
+    '''zero-phase filter chain (band-pass, then line noise notches) applied in overlapping chunks.
+    each chunk is filtered together with `margin` samples of its neighbours, which are then
+    dropped, so the result matches filtering the whole recording to within the decay of the
+    filters' impulse responses.
+    fs: sampling frequency (Hz)
+    highpass, lowpass: band edges (Hz). either may be None
+    notch: frequencies (Hz) to notch out
+    order: order of the Butterworth band-pass
+    fir_taps: if nonzero, use a linear-phase FIR band-pass with this many taps instead
+    notch_q: quality factor of the notches
+    margin: samples of overlap on either side of a chunk. defaults to 5 time constants
+        of the slowest filter
+    '''
+    def __init__(self, fs, highpass=None, lowpass=None, notch=(), order=3, fir_taps=0, notch_q=30., margin=None):
+        nyq = fs/2.
+        self.stages = []
+        if highpass or lowpass:
+            if highpass and lowpass:
+                band, btype = [highpass/nyq, lowpass/nyq], 'bandpass'
+            elif highpass:
+                band, btype = highpass/nyq, 'highpass'
+            else:
+                band, btype = lowpass/nyq, 'lowpass'
+            if fir_taps:
+                taps = signal.firwin(fir_taps | 1, band, pass_zero=(btype=='lowpass'))
+                self.stages.append(('fir', taps))
+            else:
+                self.stages.append(('sos', signal.butter(order, band, btype, output='sos')))
+        for f0 in notch:
+            b, a = signal.iirnotch(f0/nyq, notch_q)
+            self.stages.append(('sos', signal.tf2sos(b, a)))
+
+        if margin is None:
+            periods = [fs/f for f in (highpass, lowpass) if f]
+            periods += [notch_q*fs/f0 for f0 in notch]
+            margin = int(np.ceil(5*max(periods))) if periods else 0
+            if fir_taps:
+                margin = max(margin, fir_taps//2+1)
+        self.margin = margin
+
+    def _filter_channel(self, x):
+        for kind, coeffs in self.stages:
+            if kind=='sos':
+                x = signal.sosfiltfilt(coeffs, x)
+            else:
+                x = np.convolve(x, coeffs, 'same')
+        return x
+
+    def filter(self, data):
+        '''filters each channel (column) of data in its own thread. returns float64'''
+        pool = ThreadPool(min(data.shape[1], cpu_count()))
+        try:
+            columns = pool.map(self._filter_channel, [np.asarray(x, np.float64) for x in data.T])
+        finally:
+            pool.close()
+        return np.vstack(columns).T
+
+    def _filter_middle(self, before, block, after):
+        filtered = self.filter(np.vstack((before, block, after)))
+        filtered = filtered[len(before):len(before)+len(block)]
+        np.rint(filtered, out=filtered)
+        np.clip(filtered, -32768, 32767, out=filtered)
+        return filtered.astype(np.int16)
+
+    def filter_blocks(self, blocks):
+        '''filters a stream of consecutive int16 blocks, yielding blocks of the same sizes.
+        holds blocks back until the margin after the oldest one has arrived,
+        so every block gets the full margin on both sides, however short the blocks are
+        '''
+        before = None
+        pending = []
+        for block in blocks:
+            if before is None:
+                before = block[:0]
+            pending.append(block)
+            while len(pending) > 1 and sum(len(b) for b in pending[1:]) >= self.margin:
+                yield self._filter_middle(before, pending[0], np.vstack(pending[1:])[:self.margin])
+                before = np.vstack((before, pending.pop(0)))
+                before = before[max(len(before)-self.margin, 0):]
+        while pending:
+            after = np.vstack(pending[1:])[:self.margin] if len(pending) > 1 else pending[0][:0]
+            yield self._filter_middle(before, pending[0], after)
+            before = np.vstack((before, pending.pop(0)))
+            before = before[max(len(before)-self.margin, 0):]
+
+    def filter_inplace(self, data, window=WINDOW_SAMPLES):
+        '''filters an int16 array or h5py dataset in place, `window` samples at a time'''
+        bounds = list(iter_chunks(data.shape[0], window))
+        raw = (np.array(data[start:stop]) for start, stop in bounds)
+        for (start, stop), block in itertools.izip(bounds, self.filter_blocks(raw)):
+            data[start:stop] = block
+
+
+def get_preprocessor(args, fs):
+    '''Preprocessor described by make_kwd's filter arguments, or None if there is nothing to do'''
+    notch = [float(f) for f in args.notch.split(',') if f]
+    if not (args.highpass or args.lowpass or notch):
+        return None
+    return Preprocessor(fs, highpass=args.highpass, lowpass=args.lowpass, notch=notch,
+                        order=args.filter_order, fir_taps=args.fir_taps)
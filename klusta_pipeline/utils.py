@@ -5,9 +5,10 @@ import numpy as np
 import h5py as h5
 from scipy import interpolate
 from random import sample
-from klusta_pipeline import MAX_CHANS
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from klusta_pipeline import MAX_CHANS, WINDOW_SAMPLES, SPLINE_PAD, CHUNK_BYTES
 import datetime as dt
-from sklearn.linear_model import LinearRegression
 
 def validate_merge(import_list,omit):
     mat_data = []
@@ -137,14 +138,57 @@ def chunkit(t,v):
     else:
         yield t,v
 
+def chunk_bounds(t,window=WINDOW_SAMPLES):
+    '''bounded-memory equivalent of chunkit.
+    returns the (start,stop) sample bounds of the pieces chunkit would yield,
+    scanning `t` (anything supporting len() and slicing) `window` samples at a time
+    '''
+    n = len(t)
+    interval = np.inf
+    for start in xrange(0, n-1, window):
+        interval = min(interval, np.diff(t[start:start+window+1]).min())
+    breaks = []
+    for start in xrange(0, n-1, window):
+        dt = np.diff(t[start:start+window+1])
+        breaks.extend(start + np.nonzero(dt>1.5*interval)[0])
+    return zip([0]+[b+1 for b in breaks], breaks+[n])
+
+def iter_chunks(n,size):
+    '''(start,stop) bounds of consecutive blocks of at most `size` out of `n`'''
+    for start in xrange(0, n, size):
+        yield start, min(start+size, n)
+
+def _car_block(block):
+    '''common average reference of one int16 block.
+    x - (S-x)/(C-1) == (C*x - S)/(C-1), so with S the row sum this needs
+    one pass, with the numerator exact in int32
+    '''
+    n_chans = block.shape[1]
+    num = np.array(block, np.int32)
+    total = num.sum(axis=1, keepdims=True)
+    num *= n_chans
+    num -= total
+    # a non-integer quotient is at least 1/(C-1) from an integer, so the float
+    # division truncates exactly as the integer one would
+    car = np.true_divide(num, n_chans-1)
+    np.trunc(car, out=car)
+    np.clip(car, -32768, 32767, out=car)
+    return car.astype(np.int16)
+
+def do_inplace_chunked_car(data,chunk_bytes=CHUNK_BYTES):
+    '''common average reference, in place.
+    works `chunk_bytes` of temporaries at a time on an int16 array or h5py dataset
+    '''
+    rows = max(1, chunk_bytes // (16*data.shape[1]))
+    for start, stop in iter_chunks(data.shape[0],rows):
+        data[start:stop] = _car_block(data[start:stop])
+
 def do_car(data):
     '''common average reference. 
     for each channel, subtract off the mean of the other channels
     '''
-    car_data = np.empty(data.shape,data.dtype)
-    for ch,waveform in enumerate(data.T):
-        common_av = np.vstack((data.T[:ch,:],data.T[ch+1:,:])).mean(axis=0)
-        car_data[:,ch] = waveform-common_av
+    car_data = np.array(data)
+    do_inplace_chunked_car(car_data)
     return car_data
 
 def spline_realign(r,chans,fs,start,stop):
@@ -177,32 +221,177 @@ def no_realign(r,chans,fs,start,stop):
         realigned_data[:,ch] = r[lbl]['values'][0:raw_length]
     return realigned_data
 
+def time_grid_length(start,stop,step):
+    '''len(np.arange(start,stop,step)) without building it'''
+    return max(int(np.ceil((stop-start)/step)), 0)
+
+def time_grid(start,step,a,b):
+    '''np.arange(start,stop,step)[a:b] without building the whole grid.
+    follows numpy's fill rule (start + i*delta) so the values match exactly
+    '''
+    delta = (start+step)-start
+    t = start + np.arange(a,b)*delta
+    if a <= 1 < b:
+        t[1-a] = start+step
+    return t
+
+def spline_realign_window(r,chans,fs,start,stop,a,b,pad=SPLINE_PAD):
+    '''windowed spline realignment.
+    computes samples a:b of spline_realign, fitting each channel's spline only
+    to the raw samples under the window plus `pad` on either side.
+    the influence of a knot decays by ~0.27 per sample, so the result agrees
+    with the global fit to floating point precision.
+    '''
+    t_new = time_grid(start,1.0/fs,a,b)
+    realigned_data = np.empty((len(t_new), len(chans)), np.int16)
+
+    for ch,lbl in enumerate(chans):
+        interval = 1.0/np.ravel(r[lbl]['fs'])[0]
+        lo = max(int(np.floor((t_new[0]-r[lbl]['start'])/interval))-pad, 0)
+        hi = min(int(np.ceil((t_new[-1]-r[lbl]['start'])/interval))+pad+1, r[lbl]['length'])
+        spline = interpolate.InterpolatedUnivariateSpline(r[lbl]['times'][lo:hi], r[lbl]['values'][lo:hi])
+        realigned_data[:,ch] = spline(t_new)
+    return realigned_data
+
+def no_realign_window(r,chans,fs,start,stop,a,b):
+    '''windowed no realignment.
+    samples a:b of no_realign
+    '''
+    realigned_data = np.empty((b-a, len(chans)), np.int16)
+
+    for ch,lbl in enumerate(chans):
+        realigned_data[:,ch] = r[lbl]['values'][a:b]
+    return realigned_data
+
+def _sinc_taps(frac,half_width):
+    '''Blackman-windowed sinc taps that delay a signal by `frac` of a sample.
+    tap m (m = -half_width+1 ... half_width) weights the sample m samples ahead
+    '''
+    x = np.arange(-half_width+1, half_width+1) - frac
+    window = 0.42 + 0.5*np.cos(np.pi*x/half_width) + 0.08*np.cos(2*np.pi*x/half_width)
+    taps = np.sinc(x)*window
+    return taps/taps.sum()
+
+def _read_clamped(values,lo,hi):
+    '''values[lo:hi] as float64, repeating the edge samples where lo:hi runs off either end'''
+    n = len(values)
+    x = np.asarray(values[max(lo,0):min(hi,n)], np.float64)
+    return np.pad(x, (max(-lo,0), max(hi-n,0)), 'edge')
+
+def _cubic_delay(values,p):
+    '''4-point Lagrange interpolation of `values` at the fractional sample positions p'''
+    j = np.floor(p).astype(int)
+    u = p - j
+    x = _read_clamped(values, j[0]-1, j[-1]+3)
+    jj = j - j[0] + 1
+    return (-u*(u-1)*(u-2)/6*x[jj-1]
+            + (u+1)*(u-1)*(u-2)/2*x[jj]
+            - (u+1)*u*(u-2)/2*x[jj+1]
+            + (u+1)*u*(u-1)/6*x[jj+2])
+
+def _fracdelay_channel(r_ch,start,step,a,b,kernel,half_width):
+    '''samples a:b of one channel resampled onto the grid start + i*step'''
+    interval = 1.0/np.ravel(r_ch['fs'])[0]
+    if kernel=='sinc' and abs(step-interval) <= 1e-12*interval:
+        # same rate: a constant delay of k whole samples plus frac of a sample
+        delay = (start-r_ch['start'])/interval
+        k = int(np.floor(delay))
+        x = _read_clamped(r_ch['values'], a+k-half_width+1, b+k+half_width)
+        y = np.correlate(x, _sinc_taps(delay-k,half_width), 'valid')
+    else:
+        y = _cubic_delay(r_ch['values'], (time_grid(start,step,a,b)-r_ch['start'])/interval)
+    return np.clip(np.rint(y), -32768, 32767)
+
+def fracdelay_realign_window(r,chans,fs,start,stop,a,b,kernel='sinc',half_width=16):
+    '''windowed fractional-delay realignment.
+    samples a:b of the same time grid as spline_realign. each channel's offset
+    from the grid is estimated from its start and interval and removed with a
+    windowed-sinc filter (or cubic interpolation when the rates differ or
+    kernel='cubic'), one channel per thread.
+    '''
+    pool = ThreadPool(min(len(chans), cpu_count()))
+    try:
+        columns = pool.map(lambda lbl: _fracdelay_channel(r[lbl],start,1.0/fs,a,b,kernel,half_width), chans)
+    finally:
+        pool.close()
+    return np.vstack(columns).T.astype(np.int16)
+
+def cubic_realign_window(r,chans,fs,start,stop,a,b):
+    return fracdelay_realign_window(r,chans,fs,start,stop,a,b,kernel='cubic')
+
+def fracdelay_realign(r,chans,fs,start,stop,kernel='sinc',window=WINDOW_SAMPLES):
+    '''fractional-delay realignment.
+    realigns each channel with fracdelay_realign_window, `window` samples at a time
+    r: dictionary containing raw data keyed by channel label
+    chans: channel labels
+    fs: sampling frequency (Hz)
+    '''
+    n = time_grid_length(start,stop,1.0/fs)
+    realigned_data = np.empty((n, len(chans)), np.int16)
+    for a,b in iter_chunks(n,window):
+        realigned_data[a:b] = fracdelay_realign_window(r,chans,fs,start,stop,a,b,kernel=kernel)
+    return realigned_data
+
+def cubic_realign(r,chans,fs,start,stop):
+    return fracdelay_realign(r,chans,fs,start,stop,kernel='cubic')
+
 realign_methods = {
     'none':no_realign,
     'spline':spline_realign,
+    'sinc':fracdelay_realign,
+    'cubic':cubic_realign,
 }
+
+windowed_realign_methods = {
+    'none':no_realign_window,
+    'spline':spline_realign_window,
+    'sinc':fracdelay_realign_window,
+    'cubic':cubic_realign_window,
+}
+
+def realigned_length(r,chans,fs,method,start,stop):
+    '''number of samples the realignment method produces'''
+    if method=='none':
+        return int(np.amin([r[lbl]['length'] for lbl in chans]))
+    return time_grid_length(start,stop,1.0/fs)
+
+def realign_windows(r,chans,fs,method,start,stop,window=WINDOW_SAMPLES):
+    '''yields the realigned recording in consecutive blocks of `window` samples'''
+    n = realigned_length(r,chans,fs,method,start,stop)
+    for a,b in iter_chunks(n,window):
+        yield windowed_realign_methods[method](r,chans,fs,start,stop,a,b)
     
-def realign(r,chans,fs,method):
+def recording_info(r,chans,fs):
+    '''the description realign gives a recording (everything but 'data'), from the
+    start and stop of its channels alone, so r can come from index_recordings
+    '''
+    start = np.amax([r[lbl]['start'] for lbl in chans])
+    return {
+        'name': '',
+        'description': '',
+        'file_origin': r['file_origin'],
+        'start_time': start,
+        'fs': fs,
+    }
+
+def realign(r,chans,fs,method,stream=False,window=WINDOW_SAMPLES):
     '''Realignment wrapper.
     calls appropriate realignment method.
     r: dictionary containing raw data keyed by channel label
     chans: channel labels
     fs: sampling frequency (Hz)
     method: string containing the desired realignment method
+    stream: if True, 'data' is a generator of realigned blocks of `window` samples
     '''
 	
-    start = np.amax([r[lbl]['start'] for lbl in chans])
     stop = np.amin([r[lbl]['stop'] for lbl in chans])
-    
-    rec = {
-        'name': '',
-        'description': '',
-        'file_origin': r['file_origin'],
-        'start_time': start,
-        'fs': fs,
-    }
+    rec = recording_info(r,chans,fs)
+    start = rec['start_time']
 
-    rec['data'] = realign_methods[method](r, chans, fs, start, stop)
+    if stream:
+        rec['data'] = realign_windows(r, chans, fs, method, start, stop, window=window)
+    else:
+        rec['data'] = realign_methods[method](r, chans, fs, start, stop)
     return rec
 
 def subsample_data(data,npts=1000000,axis=0):
@@ -219,18 +408,53 @@ def subsample_index(data_lengths, sample_pts=1000000):
         counts[i] = min(counts[i], data_lengths[i])
     return [np.random.choice(xrange(length), size=int(count), replace=False) for length, count in zip(data_lengths, counts)]
 
-def calc_weights(rec_list):
-    linreg = LinearRegression()
-    idxs = subsample_index([len(r['data']) for r in rec_list])
-    data = np.vstack(tuple(r['data'][idx] for r, idx in zip(rec_list, idxs)))
-    coeffs = []
+def channel_covariance(data_list,chunk_bytes=CHUNK_BYTES):
+    '''covariance between the channels (columns) of all the rows of every array or
+    h5py dataset in data_list. the Gram matrix is accumulated `chunk_bytes` of
+    float64 rows at a time, shifted by the first chunk's mean to keep it well conditioned
+    '''
+    n_chans = data_list[0].shape[1]
+    rows = max(1, chunk_bytes // (8*n_chans))
+    gram = np.zeros((n_chans,n_chans))
+    total = np.zeros(n_chans)
+    shift = None
+    n = 0
+    for data in data_list:
+        for start, stop in iter_chunks(data.shape[0],rows):
+            x = np.asarray(data[start:stop], np.float64)
+            if shift is None:
+                shift = x.mean(axis=0)
+            x -= shift
+            gram += x.T.dot(x)
+            total += x.sum(axis=0)
+            n += len(x)
+    mean = total/n
+    return gram/n - np.outer(mean,mean)
 
-    for ch,waveform in enumerate(data.T):
-        X = np.vstack((data.T[:ch,:],data.T[ch+1:,:]))
-        linreg.fit(X.T,waveform)
-        coeffs.append(linreg.coef_)
+def weights_from_covariance(cov):
+    '''least squares weights predicting each channel from the others, for all channels at once.
+    with P the inverse covariance, the weights for channel i are -P[i,j]/P[i,i], j != i.
+    a dead (constant) channel gets, and contributes, zero weights
+    '''
+    precision = np.linalg.pinv(cov)
+    coeffs = []
+    for ch,row in enumerate(precision):
+        w = -row/row[ch] if row[ch] != 0 else np.zeros_like(row)
+        coeffs.append(np.delete(w,ch))
     return coeffs
 
+def calc_weights(rec_list):
+    '''weighted average reference weights from every sample of every recording.
+    'data' may be an array or an h5py dataset
+    '''
+    return weights_from_covariance(channel_covariance([r['data'] for r in rec_list]))
+
+def calc_kwd_weights(kwd):
+    '''weighted average reference weights straight from the recordings in a kwd file'''
+    with h5.File(kwd, 'r') as kwd_f:
+        recordings = sorted(kwd_f['recordings'].keys(), key=int)
+        return calc_weights([{'data': kwd_f['recordings'][rec]['data']} for rec in recordings])
+
 def do_war(data,weights):
     '''common average reference. 
     for each channel, subtract off the weighted average of the other channels
@@ -241,11 +465,38 @@ def do_war(data,weights):
         car_data[:,ch] = waveform - X.T.dot(w)
     return car_data
 
-def do_inplace_chunked_war(data, weights, gigs_chunksize=.5):
-    transform = np.eye(data.shape[1])
+def war_transform(weights):
+    '''C x C float32 matrix that applies the weighted average reference to a row vector'''
+    n_chans = len(weights)
+    transform = np.eye(n_chans, dtype=np.float32)
     for i, c in enumerate(weights):
-        transform[transform[:,i]==0,i] = -c
+        transform[np.arange(n_chans)!=i,i] = -c
+    return transform
 
-    chunks = np.linspace(0, data.shape[0], int(data.nbytes*gigs_chunksize/1024/1024/1024)+1, dtype=int)
-    for start, end in zip(chunks[:-1], chunks[1:]):
-        data[start:end,:] = data[start:end,:].dot(transform)
+def do_inplace_war(data, weights, chunk_bytes=CHUNK_BYTES):
+    '''weighted average reference, in place, on an int16 array or h5py dataset.
+    the transform is applied in float32 and rounded and saturated back to int16.
+    a row costs 10 bytes per channel at most (int16 in, float32 copy and product),
+    so no more than `chunk_bytes` of temporaries are allocated at once
+    '''
+    transform = war_transform(weights)
+    rows = max(1, chunk_bytes // (10*data.shape[1]))
+    for start, stop in iter_chunks(data.shape[0],rows):
+        referenced = np.asarray(data[start:stop], np.float32).dot(transform)
+        np.rint(referenced, out=referenced)
+        np.clip(referenced, -32768, 32767, out=referenced)
+        data[start:stop] = referenced.astype(np.int16)
+
+def do_inplace_chunked_war(data, weights, gigs_chunksize=.5):
+    do_inplace_war(data, weights, chunk_bytes=int(gigs_chunksize*1024*1024*1024))
+
+def war_kwd(kwd, weights=None, chunk_bytes=CHUNK_BYTES):
+    '''applies the weighted average reference to every recording of an existing kwd file in place.
+    weights are computed from the file itself if not given. returns the weights
+    '''
+    if weights is None:
+        weights = calc_kwd_weights(kwd)
+    with h5.File(kwd, 'r+') as kwd_f:
+        for rec in sorted(kwd_f['recordings'].keys(), key=int):
+            do_inplace_war(kwd_f['recordings'][rec]['data'], weights, chunk_bytes=chunk_bytes)
+    return weights
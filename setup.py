@@ -17,6 +17,7 @@ setup(
             'display_probe = klusta_pipeline.probe:_display',
             'kwd2dat = klusta_pipeline.kwd2dat:main',
             'kwd2mda = klusta_pipeline.kwd2mda:main',
+            'kwd_export = klusta_pipeline.kwd_export:main',
             'make_mat_chanMap = klusta_pipeline.make_mat_chanMap:main',
             'make_kilo_scripts = klusta_pipeline.make_kilo_scripts:main',
             'make_mtn_config = klusta_pipeline.make_mtn_config:main',
@@ -0,0 +1,137 @@
+import numpy as np
+import h5py as h5
+from klusta_pipeline.dataio import load_recordings, load_recording_index, index_recordings, recording_bounds, RecordingWriter
+from klusta_pipeline.utils import realign, recording_info, chunkit, chunk_bounds, time_grid
+
+CHANS = ['Port_%i' % (p+1) for p in range(4)]
+
+def make_s2mat(path, segments=(5000, 3000, 7000), fs=20000., odd_chan=None):
+    '''writes a fake spike2 export with gaps between `segments`.
+    odd_chan gets its gaps one sample later than the others
+    '''
+    rng = np.random.RandomState(0)
+    with h5.File(path, 'w') as f:
+        for ch, lbl in enumerate(CHANS):
+            t0 = 1.0 + ch*0.3/fs
+            times = []
+            for n in (segments if ch!=odd_chan else np.array(segments)+[1,0,-1]):
+                times.append(t0 + np.arange(n)/fs)
+                t0 = times[-1][-1] + 0.5
+            times = np.concatenate(times)
+            values = (np.cumsum(rng.randn(len(times)))*50).astype(np.int16)
+            f.create_dataset(lbl+'/times', data=times[None,:], chunks=(1,1024))
+            f.create_dataset(lbl+'/values', data=values[None,:], chunks=(1,1024))
+            f.create_dataset(lbl+'/interval', data=np.array([[1.0/fs]]))
+    return path
+
+def test_chunk_bounds():
+    t = np.concatenate((np.arange(10), np.arange(20,25), np.arange(40,47)))*0.1
+    bounds = chunk_bounds(t, window=4)
+    for (lo,hi), (ct,cv) in zip(bounds, chunkit(t,t)):
+        assert np.array_equal(t[lo:hi], ct)
+    assert len(bounds)==len(list(chunkit(t,t)))
+
+def test_recording_bounds(tmpdir):
+    s2mat = make_s2mat(str(tmpdir.join('s2.mat')), odd_chan=2)
+    with h5.File(s2mat, 'r') as f:
+        for stride in (100, 4096, 100000):
+            bounds = recording_bounds(f, CHANS, stride=stride)
+            for lbl in CHANS:
+                times = f[lbl]['times'][0]
+                assert bounds[lbl] == chunk_bounds(times)
+    assert bounds['Port_3'] != bounds['Port_1']
+
+def read_bytes():
+    with open('/proc/self/io') as f:
+        return int([l for l in f if l.startswith('rchar')][0].split()[1])
+
+def test_recording_bounds_reads_little(tmpdir):
+    # the times of two channels with gaps, stored contiguous and in chunks longer than the stride used to be
+    n, fs = 2**21, 20000.
+    for name, layout in (('contiguous', {}), ('chunked', dict(chunks=(1, 65536), compression='gzip'))):
+        s2mat = str(tmpdir.join(name + '.mat'))
+        with h5.File(s2mat, 'w') as f:
+            for ch, lbl in enumerate(CHANS[:2]):
+                times = 1.0 + ch*0.3/fs + np.arange(n)/fs
+                times[500000:] += 0.5
+                times[1500000:] += 0.5
+                f.create_dataset(lbl+'/times', data=times[None,:], **layout)
+                f.create_dataset(lbl+'/interval', data=np.array([[1.0/fs]]))
+        with h5.File(s2mat, 'r') as f:
+            stored = sum(f[lbl]['times'].id.get_storage_size() for lbl in CHANS[:2])
+            before = read_bytes()
+            bounds = recording_bounds(f, CHANS[:2])
+            read = read_bytes() - before
+        assert bounds['Port_1'] == bounds['Port_2'] == [(0, 499999), (500000, 1499999), (1500000, n)]
+        assert read < stored/2, (name, read, stored)
+
+def test_time_grid():
+    for start, stop in [(1.0,2.5), (3.2345,7.7), (100.00001,100.3)]:
+        grid = np.arange(start, stop, 1/20000.)
+        assert np.array_equal(grid[5:900], time_grid(start, 1/20000., 5, 900))
+        assert np.array_equal(grid[:3], time_grid(start, 1/20000., 0, 3))
+
+def test_streamed_realign_matches_in_memory(tmpdir):
+    s2mat = make_s2mat(str(tmpdir.join('s2.mat')))
+    for method in ('none', 'spline', 'sinc', 'cubic'):
+        expected = [realign(r, CHANS, 20000., method)['data'] for r in load_recordings(s2mat, CHANS)]
+        with h5.File(s2mat, 'r') as f, h5.File(str(tmpdir.join(method+'.kwd')), 'w') as kwd_f:
+            for ii, r in enumerate(index_recordings(f, CHANS, window=777)):
+                r.update(file_origin=s2mat)
+                rec = realign(r, CHANS, 20000., method, stream=True, window=1000)
+                writer = RecordingWriter(kwd_f, ii, len(CHANS))
+                for block in rec['data']:
+                    writer.write(block)
+                assert np.array_equal(writer.dset[:], expected[ii])
+                assert np.array_equal(writer.mean(), expected[ii].mean(axis=0))
+
+def test_fracdelay_realign_close_to_spline(tmpdir):
+    s2mat = make_s2mat(str(tmpdir.join('s2.mat')))
+    for r in load_recordings(s2mat, CHANS):
+        r.update(file_origin=s2mat)
+        spline = realign(r, CHANS, 20000., 'spline')['data'].astype(int)
+        for method in ('sinc', 'cubic'):
+            data = realign(r, CHANS, 20000., method)['data']
+            assert data.shape == spline.shape
+            error = np.sqrt(np.mean((data[20:-20] - spline[20:-20])**2))
+            assert error < 0.01*spline.std()
+
+def test_compressed_writer(tmpdir):
+    data = (np.random.RandomState(0).randn(2500,3)*1000).astype(np.int16)
+    with h5.File(str(tmpdir.join('c.kwd')), 'w') as kwd_f:
+        writer = RecordingWriter(kwd_f, 0, 3, chunk_rows=300, compression='gzip', shuffle=True, threads=2)
+        for start in range(0, 2500, 700):
+            writer.write(data[start:start+700])
+        writer.flush()
+        assert np.array_equal(writer.dset[:], data)
+        writer.write_at(600, -data[600:1200])
+        writer.write_at(2400, -data[2400:])
+        writer.close()
+        data[600:1200] *= -1
+        data[2400:] *= -1
+        assert np.array_equal(kwd_f['recordings/0/data'][:], data)
+        assert kwd_f['recordings/0/data'].compression == 'gzip'
+
+def test_recording_info_without_data(tmpdir):
+    s2mat = make_s2mat(str(tmpdir.join('test.mat')), odd_chan=1)
+    fs = 20000.
+    expected = []
+    for r in load_recordings(s2mat, CHANS):
+        rec = realign(r, CHANS, fs, 'spline')
+        del rec['data']
+        expected.append(rec)
+    assert [recording_info(r, CHANS, fs) for r in load_recording_index(s2mat, CHANS)] == expected
+
+def test_compressed_writer_within_one_chunk(tmpdir):
+    # read back through the writing handle, as stream_file does to remove the mean
+    for n in (250, 300):
+        data = (np.random.RandomState(n).randn(n,3)*1000).astype(np.int16)
+        with h5.File(str(tmpdir.join('c%i.kwd' % n)), 'w') as kwd_f:
+            writer = RecordingWriter(kwd_f, 0, 3, chunk_rows=300, compression='gzip', shuffle=True, threads=2)
+            for start in range(0, n, 100):
+                writer.write(data[start:start+100])
+            writer.flush()
+            assert np.array_equal(writer.dset[:], data)
+            writer.write_at(0, writer.dset[:] // 2)
+            writer.close()
+            assert np.array_equal(kwd_f['recordings/0/data'][:], data // 2)
@@ -0,0 +1,188 @@
+import numpy as np
+import h5py as h5
+from klusta_pipeline.mdaio import readmda, writemda64
+from klusta_pipeline.h5_util import KwikFile, SampleIndex, ref_to_rec_starts, h5_pool, get_rec_index, kwd_export, KwdReader, copy_file_range, contiguous_offset, get_rec_starts, kwd_to_binary, kwd_to_mda, auto_chunk_size, load_table_slice, plan_table_slice
+
+def make_kwd(path, lengths=(1000, 2500, 30), n_chans=5):
+    '''writes a kwd with recordings of `lengths` samples. returns them concatenated'''
+    rng = np.random.RandomState(0)
+    data = (rng.randn(sum(lengths), n_chans)*1000).astype(np.int16)
+    with h5.File(path, 'w') as kwd_f:
+        for rec, (start, stop) in enumerate(zip(np.cumsum((0,)+lengths[:-1]), np.cumsum(lengths))):
+            kwd_f.create_dataset('recordings/%i/data' % rec, data=data[start:stop])
+            kwd_f['recordings/%i' % rec].attrs['sample_rate'] = 20000.
+    return data
+
+def test_kwd_to_binary(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    data = make_kwd(kwd)
+    dat = str(tmpdir.join('test.dat'))
+    kwd_to_binary(kwd, dat, chunk_size=700)
+    assert np.array_equal(np.fromfile(dat, np.int16).reshape(data.shape), data)
+    kwd_to_binary(kwd, dat, chan_list=[4, 1], chunk_size=333)
+    assert np.array_equal(np.fromfile(dat, np.int16).reshape(-1, 2), data[:, [4, 1]])
+
+def test_auto_chunk_size(tmpdir):
+    with h5.File(str(tmpdir.join('chunked.h5')), 'w') as h5f:
+        dset = h5f.create_dataset('data', shape=(100000, 4), dtype=np.int16, chunks=(300, 4))
+        size = auto_chunk_size(dset, 4, n_buffers=2, max_bytes=2*4*2*1000)
+        assert size == 900
+        assert auto_chunk_size(dset, 4, n_buffers=2, max_bytes=2*4*2*100) == 100
+
+def test_load_table_slice(tmpdir):
+    data = np.arange(200*32, dtype=np.int16).reshape(200, 32)
+    with h5.File(str(tmpdir.join('slice.h5')), 'w') as h5f:
+        dset = h5f.create_dataset('data', data=data)
+        h5f.create_dataset('chunked', data=data, chunks=(50, 4), compression='gzip')
+        for rows, cols in [(None, [0, 31]), (range(10, 20), [31, 0, 5, 6, 7]),
+                           ([5, 4, 3, 150, 151], [2, 2, 3]), ([7], None)]:
+            expected = data if rows is None else data[rows]
+            expected = expected if cols is None else expected[:, cols]
+            assert np.array_equal(load_table_slice(dset, rows, cols), expected)
+            assert np.array_equal(load_table_slice(h5f['chunked'], rows, cols), expected)
+        out = np.zeros((3, 2), dtype=np.int16)
+        assert load_table_slice(dset, [1, 2, 3], [4, 9], out=out) is out
+        assert np.array_equal(out, data[1:4][:, [4, 9]])
+
+def test_plan_table_slice():
+    # rows of a contiguous table are read whole: never split the channels
+    assert plan_table_slice(np.arange(100000), np.array([0, 31]), 2, (1, 32)) == (True, False)
+    assert plan_table_slice(np.arange(100000), np.arange(0, 32, 2), 2, (1, 32)) == (True, False)
+    # chunks spanning every channel are decompressed whole either way
+    assert plan_table_slice(np.arange(100000), np.array([0, 31]), 2, (16384, 32), compressed=True) == (True, False)
+    # chunks partitioning the channels: only read the chunks holding the two far apart ones
+    assert plan_table_slice(np.arange(100000), np.array([0, 31]), 2, (16384, 4), compressed=True) == (True, True)
+    # a few samples of every other channel: one read of the bounding box
+    assert plan_table_slice(np.arange(10), np.arange(0, 32, 2), 2, (16384, 4)) == (True, False)
+
+def test_kwd_to_mda(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    data = make_kwd(kwd)
+    mda = str(tmpdir.join('raw.mda'))
+    assert kwd_to_mda(kwd, mda, chunk_size=700) == [5, len(data)]
+    assert np.array_equal(readmda(mda), data.T)
+    kwd_to_mda(kwd, mda, chan_list=[3, 0])
+    assert np.array_equal(readmda(mda), data[:, [3, 0]].T)
+
+def test_kwd_reader(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    data = make_kwd(kwd)
+    with h5.File(kwd, 'a') as kwd_f:
+        # a chunked recording is read through hdf5, the contiguous ones through memmap
+        del kwd_f['recordings/1/data']
+        kwd_f.create_dataset('recordings/1/data', data=data[1000:3500], chunks=(100, 5), compression='gzip')
+    assert get_rec_starts(kwd) == {0: 0, 1: 1000, 2: 3500}
+    with KwdReader(kwd) as reader:
+        assert reader.shape == data.shape
+        assert reader.is_mapped(0) and not reader.is_mapped(1)
+        assert np.array_equal(reader[:], data)
+        assert np.array_equal(reader[990:3510], data[990:3510])
+        assert np.array_equal(reader[3499:3501, [4, 0]], data[3499:3501, [4, 0]])
+        assert np.array_equal(reader[::7, 2], data[::7, 2])
+        assert np.array_equal(reader[[3500, 5, 1000]], data[[3500, 5, 1000]])
+        assert np.array_equal(reader[-1], data[-1])
+        assert reader[1000, 3] == data[1000, 3]
+
+def test_copy_file_range(tmpdir):
+    src = tmpdir.join('src.bin')
+    src.write_binary(b'0123456789')
+    dst = tmpdir.join('dst.bin')
+    dst.write_binary(b'abc')
+    with open(str(src), 'rb') as src_f, open(str(dst), 'r+b') as dst_f:
+        assert copy_file_range(src_f.fileno(), dst_f.fileno(), 2, 3, 5) in \
+            ('copy_file_range', 'sendfile', 'buffered_copy')
+    assert dst.read_binary() == b'abc23456'
+
+def test_kwd_to_binary_zero_copy(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    data = make_kwd(kwd)
+    with h5.File(kwd, 'a') as kwd_f:
+        del kwd_f['recordings/1/data']
+        kwd_f.create_dataset('recordings/1/data', data=data[1000:3500], chunks=(100, 5))
+        assert contiguous_offset(kwd_f['recordings/0/data']) is not None
+        assert contiguous_offset(kwd_f['recordings/1/data']) is None
+    dat = str(tmpdir.join('test.dat'))
+    kwd_to_binary(kwd, dat)
+    assert np.array_equal(np.fromfile(dat, np.int16).reshape(data.shape), data)
+
+def test_kwd_export(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    data = make_kwd(kwd)
+    dat, mda, sub = [str(tmpdir.join(f)) for f in ('test.dat', 'raw.mda', 'shank.mda')]
+    dims = kwd_export(kwd, [(dat, None, 'dat'), (mda, None, 'mda'), (sub, [4, 2], 'mda')], chunk_size=600)
+    assert dims == [[5, len(data)], [5, len(data)], [2, len(data)]]
+    assert np.array_equal(np.fromfile(dat, np.int16).reshape(data.shape), data)
+    assert np.array_equal(readmda(mda), data.T)
+    assert np.array_equal(readmda(sub), data[:, [4, 2]].T)
+
+def test_h5_pool(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    make_kwd(kwd)
+    with h5_pool.open(kwd) as outer:
+        with KwdReader(kwd) as reader:
+            assert reader.kwd_file is outer
+        assert outer.id.valid
+    assert not outer.id.valid
+
+def test_get_rec_index(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    make_kwd(kwd)
+    index = get_rec_index(kwd)
+    assert index['sizes'].tolist() == [1000, 2500, 30]
+    assert index['starts'].tolist() == [0, 1000, 3500]
+    assert index['sample_rates'] == [20000.] * 3
+    assert tmpdir.join('test.raw.kwd.index.json').check()
+    with h5.File(kwd, 'a') as kwd_f:
+        kwd_f.create_dataset('recordings/3/data', data=np.zeros((10, 5), np.int16))
+    assert get_rec_index(kwd)['sizes'].tolist() == [1000, 2500, 30, 10]
+
+def test_sample_index():
+    index = SampleIndex([100, 0, 50, 25], recordings=[0, 1, 2, 5], chunk_size=3)
+    samples = np.array([0, 99, 100, 149, 150, 174, 7])
+    rec, local = index.to_local(samples)
+    assert rec.tolist() == [0, 0, 2, 2, 5, 5, 0]
+    assert local.tolist() == [0, 99, 0, 49, 0, 24, 7]
+    assert np.array_equal(index.to_global(rec, local), samples)
+    rec, local = index.to_local(samples.reshape(-1, 1).astype(np.uint64))
+    assert rec.shape == (7, 1) and local[2, 0] == 0
+    assert index.start_of(5) == 150 and index.size_of(2) == 50
+    for bad in ([175], [-1]):
+        try:
+            index.to_local(bad)
+            assert False
+        except ValueError:
+            pass
+
+def test_ref_to_rec_starts():
+    rec, spk = ref_to_rec_starts({0: 10, 1: 10}, np.array([0, 9, 10, 19]))
+    assert rec.tolist() == [0, 0, 1, 1]
+    assert spk.tolist() == [0, 9, 0, 9]
+
+def test_kwik_file(tmpdir):
+    kwd = str(tmpdir.join('test.raw.kwd'))
+    make_kwd(kwd)
+    spk = np.array([0, 999, 1000, 3499, 3500, 3529], dtype=np.uint64)
+    clu = np.array([3, 1, 3, 7, 1, 3], dtype=np.uint32)
+    np.save(str(tmpdir.join('spike_times.npy')), spk.reshape(-1, 1))
+    np.save(str(tmpdir.join('spike_clusters.npy')), clu)
+    tmpdir.join('params.py').write('sample_rate = 20000.\n')
+    writemda64(np.vstack([np.ones(6), spk + 1., clu]), str(tmpdir.join('firings.mda')))
+    tmpdir.join('params.json').write('{"samplerate": 20000.0}')
+    kilosort = {'clu': str(tmpdir.join('spike_clusters.npy')), 'spk': str(tmpdir.join('spike_times.npy')),
+                'temp': False, 'grp': False, 'par': str(tmpdir.join('params.py'))}
+    mountainsort = {'mda': str(tmpdir.join('firings.mda')), 'param': str(tmpdir.join('params.json'))}
+    for file_names in (kilosort, mountainsort):
+        file_names.update(kwd=kwd, kwk=str(tmpdir.join('test.kwik')))
+        k = KwikFile(file_names, chunk_size=4)
+        assert [c for c, _ in k.grp] == [1, 3, 7]
+        k.make_spk_tables()
+        k.make_rec_groups()
+        with h5.File(file_names['kwk'], 'r') as kwf:
+            spikes = kwf['channel_groups/0/spikes']
+            assert spikes['recording'].dtype == np.uint16
+            assert spikes['recording'][:].tolist() == [0, 0, 1, 1, 2, 2]
+            assert spikes['time_samples'].dtype == np.uint64
+            assert spikes['time_samples'][:].tolist() == [0, 999, 0, 2499, 0, 29]
+            assert np.array_equal(spikes['clusters/main'][:], clu)
+            assert spikes['clusters/main'].maxshape == (None,)
+            assert kwf['recordings/2'].attrs['start_sample'] == 3500
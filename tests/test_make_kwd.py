@@ -0,0 +1,42 @@
+import os
+import sys
+import glob
+import json
+import numpy as np
+import h5py as h5
+from klusta_pipeline import make_kwd
+from test_dataio import make_s2mat
+
+CATLOG_LINE = '"E:\\exp\\raw\\B1\\data\\Pen01_Rgt_AP2500_ML1400\\Site01_Z1535\\Epc10_2015-06-23+21-40-11_NO_B\\%s.smrx",10.0,x,1.0,x,4\n'
+
+def make_block(path, segments=((4000, 3000), (4100, 3000), (4200, 3000))):
+    '''writes fake spike2 exports of one block and its catLog'''
+    lines = []
+    for ii, segs in enumerate(segments):
+        name = 'SubB1Pen01Site01Epc01File%02d_06-23-15+21-40-%02d_B1' % (ii+1, ii)
+        make_s2mat(os.path.join(path, name + '.mat'), segments=segs)
+        lines.append(CATLOG_LINE % name)
+    with open(os.path.join(path, 'blk.catLog'), 'w') as f:
+        f.write(''.join(lines))
+
+def run_make_kwd(monkeypatch, path, dest, *args):
+    os.makedirs(dest)
+    monkeypatch.setattr(sys, 'argv', ['make_kwd', 'paukstis32', 'A1x32-Poly3-6mm-50', path, dest] + list(args))
+    make_kwd.main()
+    with h5.File(glob.glob(os.path.join(dest, '*.raw.kwd'))[0], 'r') as kwd_f:
+        data = [kwd_f['recordings/%s/data' % k][:] for k in sorted(kwd_f['recordings'], key=int)]
+    with open(glob.glob(os.path.join(dest, '*_info.json'))[0]) as f:
+        recordings = json.load(f)['recordings']
+    return data, recordings
+
+def test_parallel_matches_serial(tmpdir, monkeypatch):
+    path = str(tmpdir.join('block'))
+    os.makedirs(path)
+    make_block(path)
+    for extra in ([], ['--stream']):
+        serial = run_make_kwd(monkeypatch, path, str(tmpdir.join('serial' + ''.join(extra))), *extra)
+        parallel = run_make_kwd(monkeypatch, path, str(tmpdir.join('parallel' + ''.join(extra))), '-j', '2', *extra)
+        assert len(serial[0]) == 6
+        assert all(np.array_equal(a, b) for a, b in zip(serial[0], parallel[0]))
+        assert serial[1] == parallel[1]
+        assert not glob.glob(str(tmpdir.join('parallel' + ''.join(extra), '*.part*')))
@@ -0,0 +1,50 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from klusta_pipeline.mdaio import DiskWriteMda, DiskReadMda, MdaHeader, _write_header, readmda, writemda16i
+
+def test_disk_read_mda(tmpdir):
+    path = str(tmpdir.join('raw.mda'))
+    X = np.arange(4*50, dtype=np.int16).reshape(4, 50)
+    writemda16i(X, path)
+    mda = DiskReadMda(path)
+    assert mda.dims() == [4, 50]
+    assert np.array_equal(mda.readChunk(i1=0, i2=10, N1=4, N2=5), X[:, 10:15])
+    chunk = mda.readChunk(i1=1, i2=48, N1=2, N2=2)
+    assert np.array_equal(chunk, X[1:3, 48:50])
+    assert np.shares_memory(chunk, mda.array())
+    assert np.array_equal(mda.readChunk(i1=6, N1=3), X.ravel(order='F')[6:9])
+    assert np.array_equal(mda.readChannels([3, 0], 20, 4), X[[3, 0], 20:24])
+
+def test_disk_read_mda_64bit_dims(tmpdir):
+    path = str(tmpdir.join('raw.mda'))
+    X = np.arange(3*7, dtype=np.float32).reshape(3, 7)
+    H = MdaHeader('float32', [3, 7])
+    H.uses64bitdims = True
+    _write_header(path, H)
+    with open(path, 'ab') as f:
+        X.ravel(order='F').tofile(f)
+    mda = DiskReadMda(path)
+    assert mda.dims() == [3, 7]
+    assert np.array_equal(mda.readChunk(i1=0, i2=2, N1=3, N2=4), X[:, 2:6])
+
+def test_readmda_mmap(tmpdir):
+    path = str(tmpdir.join('firings.mda'))
+    X = np.arange(3*20, dtype=np.int16).reshape(3, 20)
+    writemda16i(X, path)
+    firings = readmda(path, mmap=True)
+    assert isinstance(firings, np.memmap) and not firings.flags.writeable
+    assert np.array_equal(firings, X)
+    assert np.array_equal(firings[1, :], readmda(path)[1, :])
+
+def test_disk_write_mda(tmpdir):
+    path = str(tmpdir.join('raw.mda'))
+    X = np.arange(4*1000, dtype=np.int16).reshape(1000, 4).T
+    with DiskWriteMda(path, [4, 1000], dt='int16') as mda:
+        starts = range(0, 1000, 100)[::-1]
+        pool = ThreadPool(4)
+        assert all(pool.map(lambda i: mda.writeChunk(X[:, i:i+100], i1=0, i2=i), starts))
+        pool.close()
+    with DiskWriteMda(path, [4, 1000], dt='int16', create=False) as mda:
+        mda.writeChunk(np.zeros(3), i1=5)
+    X.T.ravel()[5:8] = 0
+    assert np.array_equal(readmda(path), X)
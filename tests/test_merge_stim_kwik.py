@@ -0,0 +1,23 @@
+import numpy as np
+import tables
+from klusta_pipeline.h5_util import SampleIndex
+from klusta_pipeline.merge_stim_kwik import sort_events, event_window, rehome_spikes
+
+def test_event_window():
+    events = sort_events(np.array([3., 1., 2., 5., 4.]), codes=np.array(['c', 'a', 'b', 'e', 'd']))
+    assert events['codes'].tolist() == ['a', 'b', 'c', 'd', 'e']
+    window = event_window(events, 2., 2.)
+    assert window['times'].tolist() == [2., 3.]
+    assert window['codes'].tolist() == ['b', 'c']
+    assert event_window(events, 10., 1.)['codes'].size == 0
+    assert sort_events(7., codes='x')['codes'].tolist() == ['x']
+
+def test_rehome_spikes(tmpdir):
+    with tables.open_file(str(tmpdir.join('test.kwik')), 'w') as kkfile:
+        recording = kkfile.create_carray('/', 'recording', obj=np.zeros(7, np.uint16))
+        time_samples = kkfile.create_carray('/', 'time_samples',
+                                            obj=np.array([0, 5, 9, 10, 12, 25, 29], np.uint64))
+        moved = rehome_spikes(recording, time_samples, SampleIndex([10, 15, 5]), chunk_size=3)
+        assert moved == 4
+        assert recording[:].tolist() == [0, 0, 0, 1, 1, 2, 2]
+        assert time_samples[:].tolist() == [0, 5, 9, 0, 2, 0, 4]
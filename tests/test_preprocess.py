@@ -0,0 +1,34 @@
+import numpy as np
+from klusta_pipeline.preprocess import Preprocessor
+
+def make_data(n=60000, fs=20000.):
+    rng = np.random.RandomState(0)
+    hum = 500*np.sin(2*np.pi*60*np.arange(n)/fs)
+    return (np.cumsum(rng.randn(n,4),axis=0)*20 + hum[:,None]).astype(np.int16)
+
+def test_chunked_filter_matches_whole():
+    data = make_data()
+    for kwargs in (dict(highpass=300., lowpass=6000.), dict(highpass=300., notch=[60.]), dict(lowpass=3000., fir_taps=101)):
+        preprocessor = Preprocessor(20000., **kwargs)
+        whole = preprocessor.filter(data)
+        chunked = data.copy()
+        preprocessor.filter_inplace(chunked, window=7000)
+        assert np.abs(chunked - np.rint(whole)).max() <= 1
+
+def test_filter_blocks_keeps_block_sizes():
+    data = make_data(n=10000)
+    preprocessor = Preprocessor(20000., highpass=300.)
+    blocks = [data[:4000], data[4000:8000], data[8000:]]
+    assert [len(b) for b in preprocessor.filter_blocks(iter(blocks))] == [4000, 4000, 2000]
+
+def test_blocks_shorter_than_margin():
+    # a 60 Hz notch needs 50000 samples of margin, ten times the window
+    data = make_data(n=150000)
+    preprocessor = Preprocessor(20000., highpass=300., notch=[60.])
+    assert preprocessor.margin > 5000
+    whole = np.rint(preprocessor.filter(data))
+    chunked = data.copy()
+    preprocessor.filter_inplace(chunked, window=5000)
+    assert np.array_equal(chunked, whole)
+    blocks = [data[:3000], data[3000:100000], data[100000:100001], data[100001:]]
+    assert np.array_equal(np.vstack(preprocessor.filter_blocks(iter(blocks))), whole)
@@ -1,3 +1,6 @@
+from klusta_pipeline.utils import *
+import numpy as np
+
 def test_get_pen():
     pen = 'Pen01_Rgt_AP2500_ML1400'
     result = {'anterior': 2500, 'hemisphere': 'right', 'index': 1, 'lateral': 1400}
@@ -21,7 +24,10 @@ def test_get_info():
             'index': 10,
             'prot': 'NO_B',
         },
-        'filename': 'SubB957Pen01Site01Epc10File01_06-23-15+21-40-13_B957.smrx',
+        'file': {
+            'datetime': 'Tue Jun 23 21:40:13 2015',
+            'filename': 'SubB957Pen01Site01Epc10File01_06-23-15+21-40-13_B957.smrx',
+        },
         'pen': {
             'anterior': 2500,
             'hemisphere': 'right', 
@@ -47,4 +53,30 @@ def test_get_file_info():
 def test_get_file_info_autosav():
     filename = 'AutoSv-012715_18-11-04_000.smrx'
     result = {'filename': filename, 'datetime': 'Tue Jan 27 18:11:04 2015'}
-    assert get_file_info(filename)==result
\ No newline at end of file
+    assert get_file_info(filename)==result
+
+def test_do_car():
+    data = (np.random.RandomState(0).randn(1000,7)*3000).astype(np.int16)
+    expected = np.empty(data.shape,data.dtype)
+    for ch,waveform in enumerate(data.T):
+        expected[:,ch] = waveform - np.delete(data,ch,axis=1).mean(axis=1)
+    assert np.array_equal(do_car(data), expected)
+    do_inplace_chunked_car(data, chunk_bytes=1000)
+    assert np.array_equal(data, expected)
+
+def test_calc_weights():
+    rng = np.random.RandomState(0)
+    data = (rng.randn(5000,6).dot(rng.randn(6,6))*500).astype(np.int16)
+    weights = calc_weights([{'data': data[:2000]}, {'data': data[2000:]}])
+    for ch in range(data.shape[1]):
+        X = np.hstack((np.delete(data,ch,axis=1), np.ones((len(data),1))))
+        coef = np.linalg.lstsq(X, data[:,ch], rcond=None)[0]
+        assert np.allclose(weights[ch], coef[:-1])
+
+def test_do_inplace_war():
+    rng = np.random.RandomState(0)
+    data = (rng.randn(3000,5).dot(rng.randn(5,5))*3000).astype(np.int16)
+    weights = calc_weights([{'data': data}])
+    expected = do_war(data.astype(np.float64), weights)
+    do_inplace_war(data, weights, chunk_bytes=1000)
+    assert np.abs(data - np.clip(np.rint(expected), -32768, 32767)).max() <= 1